@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+#
+
+"""Content-addressed on-disk cache of parsed input files."""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+_VERSION = 2
+"""int: bump when a parser changes what it returns, to invalidate old entries."""
+
+# attributes of the parser classes in ccParse that are kept, if present
+_FIELDS = ("CHARGES", "CARTESIANS", "FREQUENCIES", "NORMALMODES")
+
+
+def file_digest(file, block_size=1 << 20):
+    """SHA-256 digest of the contents of a file, read in blocks."""
+
+    digest = hashlib.sha256()
+    with open(file, "rb") as infile:
+        for block in iter(lambda: infile.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _bonds_to_edges(bond_index):
+    return np.array(
+        [(j, k) for j, bonded in enumerate(bond_index) for k in bonded if j < k],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+
+def _edges_to_bonds(edges, natoms):
+    bond_index = [[] for _ in range(natoms)]
+    for j, k in edges.tolist():
+        bond_index[j].append(k)
+        bond_index[k].append(j)
+
+    return [sorted(bonded) for bonded in bond_index]
+
+
+class CachedData:
+    """Parsed data restored from the cache, with the attributes of the original parser."""
+
+    def __init__(self, data):
+        # fields the parser did not have are restored empty
+        for name in _FIELDS:
+            setattr(self, name, data[name].tolist() if name in data else [])
+        self.FUNCTIONAL = str(data["FUNCTIONAL"]) if "FUNCTIONAL" in data else None
+        self.NATOMS = len(self.CHARGES)
+        if "BONDS" in data:
+            self.BONDINDEX = _edges_to_bonds(data["BONDS"], self.NATOMS)
+
+
+class ParseCache:
+    """On-disk cache of the data parsed from input files.
+
+    Entries are stored as ``.npz`` files named by the SHA-256 digest of the
+    file contents and by the parser, so identical files share an entry and an
+    edited file gets a new one. To avoid hashing large files on every run, an
+    index maps each path to its size, modification time and digest; the
+    digest is only recomputed when the size or modification time changed.
+    The index holds one small file per path, so that concurrent runs never
+    overwrite each other's entries. Files are written under a temporary name
+    and then renamed, so concurrent or interrupted runs never leave a partial
+    entry behind.
+
+    Parameters
+    ----------
+    directory : str or Path
+      Cache directory, created if needed
+    """
+
+    def __init__(self, directory):
+        self.path = Path(directory)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._index = self.path / "index"
+        self._index.mkdir(exist_ok=True)
+
+    def _write(self, target, write):
+        tmp = target.with_name(f"{target.stem}.{os.getpid()}.tmp{target.suffix}")
+        write(tmp)
+        os.replace(tmp, target)
+
+    def _index_entry(self, file):
+        # index file of a path, named by the digest of the resolved path
+        key = str(Path(file).resolve())
+        return self._index / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+
+    def digest(self, file):
+        """Digest of the contents of ``file``, from the index if it is unchanged."""
+
+        stat = os.stat(file)
+        index_entry = self._index_entry(file)
+        try:
+            with open(index_entry, "r") as infile:
+                entry = json.load(infile)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entry = None
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+
+        digest = file_digest(file)
+
+        def write(tmp):
+            with open(tmp, "w") as outfile:
+                json.dump([stat.st_size, stat.st_mtime_ns, digest], outfile)
+
+        self._write(index_entry, write)
+
+        return digest
+
+    def parse(self, file, parser):
+        """Return ``parser(file)``, or its cached data if ``file`` was parsed before."""
+
+        entry = self.path / f"{self.digest(file)}-{parser.__name__}-v{_VERSION}.npz"
+        if entry.exists():
+            with np.load(entry) as data:
+                return CachedData(data)
+
+        parsed = parser(file)
+        arrays = {
+            name: np.asarray(getattr(parsed, name))
+            for name in _FIELDS
+            if getattr(parsed, name, None) is not None
+        }
+        if getattr(parsed, "FUNCTIONAL", None) is not None:
+            arrays["FUNCTIONAL"] = np.array(parsed.FUNCTIONAL)
+        if getattr(parsed, "BONDINDEX", None) is not None:
+            arrays["BONDS"] = _bonds_to_edges(parsed.BONDINDEX)
+
+        self._write(entry, lambda tmp: np.savez(tmp, **arrays))
+
+        return parsed
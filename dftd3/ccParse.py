@@ -32,14 +32,50 @@
 #                Reads compchem job file(s)                   #
 ###############################################################
 
+import bz2
+import gzip
+import lzma
+import mmap
 import os
+import re
 import sys
+from itertools import islice
+from pathlib import Path
 
+import numpy as np
 from qcelemental import periodictable as PT
 
 from .constants import AU_TO_ANG
 
 
+# compressed files are decompressed as they are read
+_DECOMPRESSORS = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}
+
+
+def is_compressed(file):
+    return Path(file).suffix in _DECOMPRESSORS
+
+
+def input_extension(file):
+    """Extension of an input file, ignoring a compression suffix, e.g. ``.log`` for ``job.log.gz``."""
+    file = Path(file)
+    return file.with_suffix("").suffix if is_compressed(file) else file.suffix
+
+
+def input_stem(file):
+    """Name of an input file without its extension or compression suffix."""
+    file = Path(file)
+    return file.with_suffix("").stem if is_compressed(file) else file.stem
+
+
+def open_input(file, mode="r"):
+    """Open an input file for reading, decompressing it on the fly if compressed."""
+    opener = _DECOMPRESSORS.get(Path(file).suffix)
+    if opener is None:
+        return open(file, mode)
+    return opener(file, mode if "b" in mode else "rt")
+
+
 ## Check for integer when parsing ##
 def is_number(s):
     try:
@@ -49,27 +85,161 @@ def is_number(s):
         return False
 
 
-# Read Cartesian coordinate data from a PDB file
+# element symbol (upper case) to atomic number
+_SYMBOL_TO_Z = {symbol.upper(): Z for Z, symbol in enumerate(PT.E) if Z > 0}
+
+
+def _atomic_numbers(symbols):
+    """Atomic numbers of an array of element symbols (or atomic numbers).
+
+    Each distinct symbol is looked up once.
+    """
+    unique, inverse = np.unique(np.asarray(symbols, dtype=str), return_inverse=True)
+    table = []
+    for symbol in unique:
+        if is_number(symbol):
+            table.append(int(symbol))
+        elif symbol.upper() in _SYMBOL_TO_Z:
+            table.append(_SYMBOL_TO_Z[symbol.upper()])
+        else:
+            table.append(PT.to_Z(symbol))
+    return np.array(table, dtype=int)[inverse.reshape(-1)]
+
+
+def _columns(lines, start, stop):
+    """Fixed-width columns ``[start:stop)`` of an array of byte strings, as an array of byte strings."""
+    chars = lines.view("S1").reshape(len(lines), -1)[:, start:stop]
+    return np.ascontiguousarray(chars).view(f"S{stop - start}").reshape(-1)
+
+
+def _read_pdb(file):
+    """Atomic numbers, Cartesians (in bohr, shape (natoms, 3)) and model numbers of the atoms in a PDB file.
+
+    Only ATOM and HETATM records are read, by their fixed columns. The
+    element is taken from columns 77-78 or, if blank, from columns 13-14 of
+    the atom name, where the PDB format puts the element symbol right-justified
+    (" CA " is carbon, "CA  " calcium, "1HB " hydrogen). Four-character names
+    starting with H, such as "HG11", are hydrogens.
+    """
+    records = []
+    models = []
+    model = 0
+    with open_input(file, "rb") as infile:
+        for line in infile:
+            tag = line[:6]
+            if tag == b"ATOM  " or tag == b"HETATM":
+                records.append(line.rstrip(b"\r\n"))
+                models.append(model)
+            elif tag == b"MODEL ":
+                model += 1
+            elif tag == b"ENDMDL":
+                model = max(model, 1)
+
+    if not records:
+        return np.zeros(0, dtype=int), np.zeros((0, 3)), np.zeros(0, dtype=int)
+
+    lines = np.array(records, dtype="S80")
+    cartesians = np.stack(
+        [_columns(lines, start, start + 8).astype(float) for start in (30, 38, 46)],
+        axis=1,
+    )
+    elements = np.char.strip(_columns(lines, 76, 78))
+    blank = elements == b""
+    if blank.any():
+        # element symbol of the atom name, without a leading digit
+        names = np.char.strip(np.char.lstrip(_columns(lines, 12, 14), b" 0123456789"))
+        # four-character hydrogen names such as HG11 or HE21 start in column
+        # 13, but are not mercury or helium
+        hydrogens = (_columns(lines, 12, 13) == b"H") & (
+            np.char.strip(_columns(lines, 15, 16)) != b""
+        )
+        names[hydrogens] = b"H"
+        elements[blank] = names[blank]
+    charges = _atomic_numbers(np.char.decode(elements))
+
+    return charges, cartesians / AU_TO_ANG, np.array(models, dtype=int)
+
+
+def _read_cif(file):
+    """Atomic numbers, Cartesians (in bohr, shape (natoms, 3)) and model numbers of the atoms in an mmCIF file."""
+    fields = []
+    rows = []
+    with open_input(file, "r") as infile:
+        lines = iter(infile)
+        for line in lines:
+            if line.startswith("_atom_site."):
+                fields.append(line.split()[0][len("_atom_site.") :])
+            elif fields:
+                if line.startswith(("_", "loop_", "#")) or not line.strip():
+                    break
+                rows.append(line)
+
+    if not rows:
+        return np.zeros(0, dtype=int), np.zeros((0, 3)), np.zeros(0, dtype=int)
+
+    text = "".join(rows)
+    if "'" in text or '"' in text:
+        tokens = re.findall(r"'[^']*'|\"[^\"]*\"|\S+", text)
+    else:
+        tokens = text.split()
+    table = np.array(tokens, dtype=str).reshape(-1, len(fields))
+    column = {name: i for i, name in enumerate(fields)}
+
+    cartesians = table[:, [column["Cartn_x"], column["Cartn_y"], column["Cartn_z"]]]
+    charges = _atomic_numbers(table[:, column["type_symbol"]])
+    if "pdbx_PDB_model_num" in column:
+        models = table[:, column["pdbx_PDB_model_num"]].astype(int)
+    else:
+        models = np.zeros(len(table), dtype=int)
+
+    return charges, cartesians.astype(float) / AU_TO_ANG, models
+
+
+def _iter_models(charges, cartesians, models):
+    for index, model in enumerate(np.unique(models)):
+        atoms = models == model
+        yield index, None, charges[atoms].tolist(), cartesians[atoms].reshape(-1).tolist()
+
+
+def iter_pdb_frames(file):
+    """Yield every MODEL of a PDB file, in the format of ``iter_gaussian_frames``."""
+    yield from _iter_models(*_read_pdb(file))
+
+
+def iter_cif_frames(file):
+    """Yield every model of an mmCIF file, in the format of ``iter_gaussian_frames``."""
+    yield from _iter_models(*_read_cif(file))
+
+
+# Read Cartesian coordinate data from the first model of a PDB file
 class getpdbData:
     def __init__(self, file):
         if not os.path.exists(file):
             print("\nFATAL ERROR: Input file [ %s ] does not exist" % file)
             sys.exit()
 
-        def getATOMS(self, inlines):
-            self.CHARGES = []
-            self.CARTESIANS = []
-            for i in range(0, len(inlines)):
-                if inlines[i].find("ATOM") > -1 or inlines[i].find("HETATM") > -1:
-                    self.CHARGES.append(float((PT.to_Z(inlines[i].split()[2]))))
-                    self.CARTESIANS += [
-                        float(coordinate) / AU_TO_ANG
-                        for coordinate in inlines[i].split()[4:7]
-                    ]
+        frame = next(iter_pdb_frames(file), None)
+        if frame is None:
+            print("\nFATAL ERROR: No ATOM or HETATM records in input file [ %s ]" % file)
+            sys.exit()
+        _, _, self.CHARGES, self.CARTESIANS = frame
+        self.NATOMS = len(self.CHARGES)
+        self.FUNCTIONAL = None
+
 
-        infile = open(file, "r")
-        inlines = infile.readlines()
-        getATOMS(self, inlines)
+# Read Cartesian coordinate data from the first model of an mmCIF file
+class getcifData:
+    def __init__(self, file):
+        if not os.path.exists(file):
+            print("\nFATAL ERROR: Input file [ %s ] does not exist" % file)
+            sys.exit()
+
+        frame = next(iter_cif_frames(file), None)
+        if frame is None:
+            print("\nFATAL ERROR: No _atom_site records in input file [ %s ]" % file)
+            sys.exit()
+        _, _, self.CHARGES, self.CARTESIANS = frame
+        self.NATOMS = len(self.CHARGES)
         self.FUNCTIONAL = None
 
 
@@ -125,35 +295,42 @@ class getinData:
                         self.FUNCTIONAL = "TPSSTPSS"
 
         def getBONDINDEX(self, inlines, natoms):
-            conn = []
-            connectivity = 0
-
-            for j in range(0, len(inlines)):
-                if " 1 " in inlines[j]:
-                    startconn = j
-                    connectivity = 1
+            # with geom=connectivity, each line of the section that follows the
+            # molecule specification lists an atom, then its bonded atoms and
+            # bond orders; bonds are kept as sorted lists of neighbours per atom
+            self.BONDINDEX = None
+            lines = iter(inlines)
+            for line in lines:
+                if line.find("#") > -1:
                     break
-
-            if connectivity == 1:
-                for j in range(startconn, len(inlines)):
-                    conn.append(inlines[j])
-
-            self.BONDINDEX = []
-            for j in range(0, natoms):
-                self.BONDINDEX.append([0])
-                for k in range(0, natoms):
-                    self.BONDINDEX[j].append(0)
-
-            for j in range(0, natoms):
-                if connectivity == 1:
-                    for bonded in conn[j].split():
-                        if is_number(bonded) == True:
-                            if int(bonded) - 1 != j:
-                                self.BONDINDEX[j][int(bonded) - 1] = 1
-                                self.BONDINDEX[int(bonded) - 1][j] = 1
-
-        infile = open(file, "r")
-        inlines = infile.readlines()
+            # the route, title and molecule specification each end with a
+            # blank line; only the route is searched for the keyword
+            route = line
+            for line in lines:
+                if len(line.split()) == 0:
+                    break
+                route += line
+            if "connectivity" not in route.casefold():
+                return
+            for _ in range(2):
+                for line in lines:
+                    if len(line.split()) == 0:
+                        break
+
+            neighbours = [set() for _ in range(natoms)]
+            for line in islice(lines, natoms):
+                fields = line.split()
+                if not fields:
+                    break
+                j = int(fields[0]) - 1
+                for bonded in fields[1::2]:
+                    k = int(bonded) - 1
+                    neighbours[j].add(k)
+                    neighbours[k].add(j)
+            self.BONDINDEX = [sorted(bonded) for bonded in neighbours]
+
+        with open_input(file, "r") as infile:
+            inlines = infile.readlines()
         getCHARGES(self, inlines)
         self.NATOMS = len(self.CHARGES)
         getMETHOD(self, inlines)
@@ -161,6 +338,113 @@ class getinData:
         getCARTESIANS(self, inlines, self.NATOMS)
 
 
+def _scan_gaussian_output(lines):
+    """Single pass over the lines of a Gaussian output file.
+
+    Yields events as the relevant sections are read, so that only the section
+    at hand is ever held in memory:
+
+      - ``("geometry", title, rows)`` for every orientation block
+      - ``("step", number)`` for every optimization step or IRC point header
+      - ``("archive", line)`` for the first line of the archive entry
+      - ``("frequencies",)`` at the start of a frequency analysis
+      - ``("modes", frequencies, rows)`` for every group of normal modes
+    """
+    lines = iter(lines)
+    for line in lines:
+        if (
+            "Input orientation" in line
+            or "Standard orientation" in line
+            or "Vib.Av.Geom." in line
+        ):
+            title = line.strip()
+            # skip the column headers
+            for _ in islice(lines, 4):
+                pass
+            rows = []
+            for row in lines:
+                if "-----" in row:
+                    break
+                rows.append(row.split())
+            yield ("geometry", title, rows)
+        elif "Step number" in line:
+            yield ("step", int(line.split()[2]))
+        elif "Point Number:" in line:
+            yield ("step", int(line.split()[2]))
+        elif "\\GINC" in line:
+            yield ("archive", line.strip())
+        elif "Harmonic frequencies" in line:
+            yield ("frequencies",)
+        elif "Frequencies --" in line:
+            frequencies = [float(freq) for freq in line.split()[2:]]
+        elif "Atom  AN" in line:
+            rows = []
+            for row in lines:
+                fields = row.split()
+                if len(fields) != 2 + 3 * len(frequencies) or not is_number(
+                    fields[0]
+                ):
+                    break
+                rows.append(fields)
+            yield ("modes", frequencies, rows)
+
+
+def _orientation_to_geometry(title, rows):
+    """Atomic numbers, atomic types and Cartesians (in bohr) of an orientation block."""
+    charges = []
+    atomictypes = []
+    cartesians = []
+    for fields in rows:
+        charges.append(int(fields[1]))
+        atomictypes.append(int(fields[2]))
+        if "Vib.Av.Geom." in title:
+            cartesians += [float(coordinate) / AU_TO_ANG for coordinate in fields[2:5]]
+        elif len(fields) > 5:
+            cartesians += [float(coordinate) / AU_TO_ANG for coordinate in fields[3:6]]
+        else:
+            cartesians += [float(coordinate) for coordinate in fields[2:5]]
+    return charges, atomictypes, cartesians
+
+
+def iter_gaussian_frames(file, orientation=None):
+    """Yield every geometry of a Gaussian output, e.g. an optimization, scan or IRC.
+
+    Parameters
+    ----------
+    file : str or Path
+    orientation : str
+      Title of the orientation blocks to read, e.g. ``"Input orientation"``
+      or ``"Standard orientation"``. By default, the kind of the first block
+      in the file is used, so each geometry is read once.
+
+    Yields
+    ------
+    Tuple of frame index (counting from 0), step number, atomic numbers and
+    Cartesians (in bohr). Gaussian prints the step (or IRC point) header after
+    the geometry it belongs to, so the step number is that of the last header
+    read before the geometry, i.e. the number of completed steps, and ``None``
+    for the starting geometry.
+    """
+    if not os.path.exists(file):
+        print("\nFATAL ERROR: Output file [ %s ] does not exist" % file)
+        sys.exit()
+
+    index = 0
+    step = None
+    with open_input(file, "r") as outfile:
+        for event in _scan_gaussian_output(outfile):
+            if event[0] == "step":
+                step = event[1]
+            elif event[0] == "geometry":
+                title, rows = event[1:]
+                if orientation is None and "Vib.Av.Geom." not in title:
+                    orientation = title.rstrip(":")
+                if title.rstrip(":") == orientation:
+                    charges, _, cartesians = _orientation_to_geometry(title, rows)
+                    yield index, step, charges, cartesians
+                    index += 1
+
+
 # Read Cartesian data from a Gaussian formatted output file (*.log or *.out)
 class getoutData:
     def __init__(self, file):
@@ -168,66 +452,44 @@ class getoutData:
             print("\nFATAL ERROR: Output file [ %s ] does not exist" % file)
             sys.exit()
 
-        def getCHARGES(self, outlines):
-            self.CHARGES = []
-            self.CARTESIANS = []
-            self.ATOMICTYPES = []
-
-            anharmonic_geom = 0
-            for i in range(0, len(outlines)):
-                if outlines[i].find("Input orientation") > -1:
-                    standor = i
-                if outlines[i].find("Standard orientation") > -1:
-                    standor = i
-                if outlines[i].find("Vib.Av.Geom.") > -1:
-                    standor = i
-                    anharmonic_geom = 1
-                if (
-                    outlines[i].find("Distance matrix") > -1
-                    or outlines[i].find("Rotational constants") > -1
-                ):
-                    if outlines[i - 1].find("-------") > -1:
-                        self.NATOMS = i - standor - 6
-
-            try:
-                standor
-            except NameError:
-                pass
-            else:
-                for i in range(standor + 5, standor + 5 + self.NATOMS):
-                    self.CHARGES.append(int(outlines[i].split()[1]))
-                    self.ATOMICTYPES.append(int(outlines[i].split()[2]))
-
-                    if anharmonic_geom == 0:
-                        if len(outlines[i].split()) > 5:
-                            self.CARTESIANS += [
-                                float(coordinate) / AU_TO_ANG
-                                for coordinate in outlines[i].split()[3:6]
-                            ]
-                        else:
-                            self.CARTESIANS += [
-                                float(coordinate)
-                                for coordinate in outlines[i].split()[2:5]
-                            ]
-                    if anharmonic_geom == 1:
-                        self.CARTESIANS += [
-                            float(coordinate) / AU_TO_ANG
-                            for coordinate in outlines[i].split()[2:5]
-                        ]
-
-        def getMETHOD(self, outlines):
-            self.FUNCTIONAL = None
-            for i in range(0, len(outlines)):
-                if outlines[i].strip().find("\GINC") > -1:
-                    if len(outlines[i].strip().split("\\")) > 5:
-                        func = outlines[i].strip().split("\\")[4]
+        self.FUNCTIONAL = None
+        # normal modes of the last frequency calculation, one row per mode
+        self.FREQUENCIES = []
+        self.NORMALMODES = []
+
+        # only the last orientation block is kept
+        geometry = None
+        with open_input(file, "r") as outfile:
+            for event in _scan_gaussian_output(outfile):
+                if event[0] == "geometry":
+                    geometry = event[1:]
+                elif event[0] == "archive":
+                    if len(event[1].split("\\")) > 5:
+                        func = event[1].split("\\")[4]
                         self.FUNCTIONAL = func[1:]
+                elif event[0] == "frequencies":
+                    self.FREQUENCIES = []
+                    self.NORMALMODES = []
+                elif event[0] == "modes":
+                    freqs, rows = event[1:]
+                    self.FREQUENCIES += freqs
+                    for m in range(len(freqs)):
+                        self.NORMALMODES.append(
+                            [
+                                float(displacement)
+                                for fields in rows
+                                for displacement in fields[2 + 3 * m : 5 + 3 * m]
+                            ]
+                        )
 
-        if os.path.exists(file):
-            outfile = open(file, "r")
-        outlines = outfile.readlines()
-        getMETHOD(self, outlines)
-        getCHARGES(self, outlines)
+        self.CHARGES = []
+        self.ATOMICTYPES = []
+        self.CARTESIANS = []
+        if geometry is not None:
+            self.CHARGES, self.ATOMICTYPES, self.CARTESIANS = _orientation_to_geometry(
+                *geometry
+            )
+        self.NATOMS = len(self.CHARGES)
 
 
 class get_simple_data:
@@ -258,6 +520,181 @@ class get_simple_data:
                 else:
                     continue
 
-        with open(file) as simple_data:
+        with open_input(file) as simple_data:
             lines = simple_data.readlines()
             info_getter(lines)
+
+
+def _xyz_columns(comment):
+    """Columns of the species and of the x coordinate in an (extended) XYZ atom line."""
+    for field in comment.split():
+        if field.startswith("Properties="):
+            properties = field[len("Properties=") :].split(":")
+            columns = {}
+            column = 0
+            for name, _, count in zip(*[iter(properties)] * 3):
+                columns[name] = column
+                column += int(count)
+            return columns.get("species", 0), columns.get("pos", 1)
+    return 0, 1
+
+
+def _parse_xyz_frame(natoms, comment, body):
+    """Atomic numbers and Cartesians (in bohr) of an XYZ frame, as NumPy arrays."""
+    species, pos = _xyz_columns(comment)
+
+    tokens = body.split()
+    lines = body.split("\n")[:natoms]
+    counts = set(map(len, map(str.split, lines)))
+    if len(counts) == 1 and counts.pop() * natoms == len(tokens):
+        # as many columns on every line: convert in bulk
+        fields = np.array(tokens, dtype=str).reshape(natoms, -1)
+    else:
+        fields = np.array([line.split()[: pos + 3] for line in lines], dtype=str)
+    charges = _atomic_numbers(fields[:, species])
+    cartesians = fields[:, pos : pos + 3].astype(float) / AU_TO_ANG
+
+    return charges, cartesians.reshape(-1)
+
+
+class XYZTrajectory:
+    """Lazily indexed, memory-mapped single- or multi-frame (extended) XYZ file.
+
+    Opening the file only locates the start of each frame, scanning it in
+    blocks with NumPy; frames are parsed on access. Coordinates are read in
+    Angstrom and returned in bohr. Compressed files cannot be memory-mapped;
+    read them in order with ``iter_xyz_frames``.
+    """
+
+    def __init__(self, file):
+        if not os.path.exists(file):
+            print("\nFATAL ERROR: Input file [ %s ] does not exist" % file)
+            sys.exit()
+
+        if is_compressed(file):
+            raise RuntimeError(
+                f"{file} is compressed and cannot be memory-mapped; use iter_xyz_frames."
+            )
+
+        self._file = None
+        if os.path.getsize(file) > 0:
+            self._file = open(file, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+        self._offsets = []
+        self._index()
+
+    def _index(self):
+        # a frame with natoms atoms spans natoms + 2 lines: jump from header
+        # to header, counting newlines over a window sized after the last frame
+        size = len(self._map)
+        data = np.frombuffer(self._map, dtype=np.uint8)
+        offset = 0
+        window = 4096
+        while offset < size:
+            end = self._map.find(b"\n", offset)
+            header = self._map[offset : end if end > -1 else size].strip()
+            if not header:
+                break
+            natoms = int(header)
+            while True:
+                newlines = np.flatnonzero(data[offset : offset + window] == 10)
+                if len(newlines) >= natoms + 2 or offset + window >= size:
+                    break
+                window *= 2
+            self._offsets.append(offset)
+            if len(newlines) < natoms + 2:
+                break
+            length = int(newlines[natoms + 1]) + 1
+            offset += length
+            window = length + length // 4 + 64
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _text(self, frame):
+        if frame < 0:
+            frame += len(self)
+        start = self._offsets[frame]
+        if frame + 1 < len(self):
+            stop = self._offsets[frame + 1]
+        else:
+            stop = len(self._map)
+        lines = self._map[start:stop].decode().split("\n", 2)
+        header, comment, body = (lines + ["", ""])[:3]
+        return int(header), comment.strip(), body
+
+    def __getitem__(self, frame):
+        """Atomic numbers and Cartesians (in bohr) of a frame, as NumPy arrays."""
+        return _parse_xyz_frame(*self._text(frame))
+
+    def __iter__(self):
+        for frame in range(len(self)):
+            yield self[frame]
+
+    def comment(self, frame):
+        """Comment line of a frame."""
+        return self._text(frame)[1]
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def _stream_xyz_frames(file):
+    # sequential read, for compressed files that cannot be memory-mapped
+    with open_input(file, "r") as infile:
+        for header in infile:
+            if not header.strip():
+                break
+            natoms = int(header)
+            comment = next(infile).strip()
+            yield _parse_xyz_frame(natoms, comment, "".join(islice(infile, natoms)))
+
+
+def iter_xyz_frames(file):
+    """Yield every frame of an (extended) XYZ file, possibly compressed.
+
+    Yields
+    ------
+    Tuple of frame index, ``None`` (XYZ files have no step numbers), atomic
+    numbers and Cartesians (in bohr), as for ``iter_gaussian_frames``.
+    """
+    if is_compressed(file):
+        for index, (charges, cartesians) in enumerate(_stream_xyz_frames(file)):
+            yield index, None, charges.tolist(), cartesians.tolist()
+        return
+
+    trajectory = XYZTrajectory(file)
+    try:
+        for index, (charges, cartesians) in enumerate(trajectory):
+            yield index, None, charges.tolist(), cartesians.tolist()
+    finally:
+        trajectory.close()
+
+
+# Read Cartesian data from the first frame of an XYZ file. NFRAMES is None
+# for compressed files, which are only decompressed as far as the first frame
+class getxyzData:
+    def __init__(self, file):
+        if is_compressed(file):
+            if not os.path.exists(file):
+                print("\nFATAL ERROR: Input file [ %s ] does not exist" % file)
+                sys.exit()
+            frames = _stream_xyz_frames(file)
+            charges, cartesians = next(frames)
+            frames.close()
+            self.NFRAMES = None
+        else:
+            trajectory = XYZTrajectory(file)
+            charges, cartesians = trajectory[0]
+            self.NFRAMES = len(trajectory)
+            trajectory.close()
+
+        self.CHARGES = charges.tolist()
+        self.CARTESIANS = cartesians.tolist()
+        self.NATOMS = len(self.CHARGES)
+        self.FUNCTIONAL = None
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+#
+
+"""Checkpoint/restart of long derivative jobs."""
+
+import hashlib
+import json
+import os
+from dataclasses import asdict
+from pathlib import Path
+
+import numpy as np
+
+from .utils import geometry_hash
+
+
+def checkpoint_key(order, config, charges, coordinates, **options):
+    """Key identifying a derivative job by its configuration, geometry and order.
+
+    The number of processors does not change the result and is left out.
+    """
+
+    settings = asdict(config)
+    settings.pop("nprocs")
+    job = {
+        "config": settings,
+        "geometry": geometry_hash(charges, coordinates),
+        "order": order,
+        **options,
+    }
+
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+
+class DerivativeCheckpoint:
+    """Completed components of a derivative job, kept on disk.
+
+    Components are buffered and written out every ``interval`` components
+    as a new, numbered segment file, so that the cost of a checkpoint does
+    not grow with the length of the job. Segments are first written to a
+    temporary name and then renamed, so a job killed while writing leaves
+    no partial segment behind.
+
+    Parameters
+    ----------
+    directory : str or Path
+      Root directory for checkpoints; each job gets a subdirectory named by its key
+    key : str
+      Job key, see ``checkpoint_key``
+    resume : bool
+      Keep the segments of an earlier run of the same job rather than starting afresh
+    interval : int
+      Number of components between two checkpoints
+    """
+
+    def __init__(self, directory, key, resume=False, interval=1024):
+        self.path = Path(directory) / key
+        self.interval = interval
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        if not resume:
+            for segment in self._segments():
+                segment.unlink()
+
+        self._count = len(self._segments())
+        self._addresses = []
+        self._values = []
+
+    def _segments(self):
+        return sorted(self.path.glob("part-*[0-9].npz"))
+
+    def load(self):
+        """Flat addresses and values of all components checkpointed so far."""
+
+        addresses = [np.zeros(0, dtype=np.int64)]
+        values = [np.zeros(0)]
+        for segment in self._segments():
+            with np.load(segment) as data:
+                addresses.append(data["addresses"])
+                values.append(data["values"])
+
+        return np.concatenate(addresses), np.concatenate(values)
+
+    def add(self, address, value):
+        self._addresses.append(address)
+        self._values.append(value)
+        if len(self._addresses) >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self._addresses:
+            return
+
+        self._count += 1
+        segment = self.path / f"part-{self._count:08d}.npz"
+        tmp = self.path / f"part-{self._count:08d}.tmp.npz"
+        np.savez(
+            tmp,
+            addresses=np.array(self._addresses, dtype=np.int64),
+            values=np.array(self._values, dtype=float),
+        )
+        os.replace(tmp, segment)
+
+        self._addresses = []
+        self._values = []
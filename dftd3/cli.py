@@ -31,6 +31,16 @@ import argparse
 from pathlib import Path
 
 
+def atom_ranges(text):
+    """Atoms from a comma-separated list of 1-based numbers and ranges, e.g. 1-5,8, as 0-based indices."""
+    atoms = []
+    for item in text.split(","):
+        first, _, last = item.partition("-")
+        atoms.extend(range(int(first) - 1, int(last or first)))
+
+    return atoms
+
+
 def cli():
     cli = argparse.ArgumentParser(description="Front-end CLI for pyDFTD3")
     cli.add_argument("--verbose", "-v", action="count", default=1)
@@ -49,6 +59,41 @@ def cli():
         type=int,
         help="number of processors to use",
     )
+    cli.add_argument(
+        "--jobs",
+        action="store",
+        default=1,
+        type=int,
+        help="number of input files to process concurrently, each on one processor "
+        "(not combined with --nprocs)",
+    )
+    cli.add_argument(
+        "--unordered",
+        action="store_true",
+        help="with --jobs, collect results as files finish instead of in input order",
+    )
+    cli.add_argument(
+        "--jsonl",
+        action="store",
+        default=None,
+        metavar="PATH",
+        help="write one JSON record per input file to PATH, or to standard output if -, "
+        "instead of a JSON file per input",
+    )
+    cli.add_argument(
+        "--binary",
+        action="store_true",
+        help="write derivative tensors and pair energies to .npy files and only their "
+        "shape and dtype to the JSON output",
+    )
+    cli.add_argument(
+        "--cache",
+        action="store",
+        default=None,
+        type=Path,
+        metavar="DIR",
+        help="reuse the data parsed from unchanged input files, cached in DIR",
+    )
     cli.add_argument(
         "--s6",
         action="store",
@@ -98,6 +143,43 @@ def cli():
         type=int,
         help="derivative order to compute",
     )
+    cli.add_argument(
+        "--sum-rules",
+        action="store_true",
+        help="reconstruct the derivatives of the last atom from the translational sum rules",
+    )
+    cli.add_argument(
+        "--checkpoint",
+        action="store",
+        default=None,
+        type=Path,
+        help="directory where completed derivative components are periodically saved",
+    )
+    cli.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the derivative components already saved in the checkpoint directory",
+    )
+    cli.add_argument(
+        "--modes",
+        action="store_true",
+        help="project the derivatives onto the normal modes of a Gaussian output file",
+    )
+    cli.add_argument(
+        "--frames",
+        action="store_true",
+        help="also compute the D3 energy of every geometry (optimization step, trajectory frame or model) in the input file",
+    )
+    cli.add_argument(
+        "--fragments",
+        action="store_true",
+        help="also compute the matrix of pairwise D3 interaction energies between molecular fragments",
+    )
+    cli.add_argument(
+        "--decompose",
+        action="store_true",
+        help="also compute the D3 energy of every atom and the 2-body D3 energy of every pair of elements",
+    )
     cli.add_argument(
         "--three",
         action="store_true",
@@ -108,10 +190,35 @@ def cli():
         action="store_true",
         help="document me",
     )
+    cli.add_argument(
+        "--bonded-scaling",
+        action="store_true",
+        help="exclude 1-2 and 1-3 pairs and scale down 1-4 pairs, from the connectivity or inferred bonds",
+    )
+    cli.add_argument(
+        "--region",
+        action="store",
+        default=None,
+        type=atom_ranges,
+        metavar="ATOMS",
+        help="only compute the pairs with an atom of the region, e.g. 1-20,25 (numbered "
+        "from 1), and derivatives with respect to its coordinates; the 3-body term "
+        "leaves out the triples with two atoms outside the region",
+    )
+    cli.add_argument(
+        "--region-cutoff",
+        action="store",
+        default=None,
+        type=float,
+        help="with --region, leave out the atoms farther than this from the region, "
+        "in angstrom (default: about 50.2, the 2-body cutoff of Grimme's dftd3)",
+    )
     cli.add_argument(
         "--pairwise",
         action="store_true",
-        help="document me",
+        help="also compute the R^-6, R^-8 and total D3 energy of every atom pair, "
+        "written to {stem}_pairs.npy with --binary or beyond 10000 pairs (not "
+        "combined with --region)",
     )
     cli.add_argument(
         "infiles", nargs=argparse.REMAINDER, type=Path, help="input file(s)"
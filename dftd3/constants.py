@@ -52,3 +52,14 @@ ALPHA8 = ALPHA6 + 2
 
 ALPHA10 = ALPHA8 + 2
 """int: exponent used in distance-dependent damping factor for R^-10 term."""
+
+BONDED_SCALING = {1: 0.0, 2: 0.0, 3: 1 / 1.2}
+"""Dict[int, float]: scale factor of 1-2, 1-3 and 1-4 pair terms, by number of bonds."""
+
+CN_CUTOFF = 40.0
+"""float: distance in bohr beyond which atoms are not counted in the coordination
+numbers of a region-restricted calculation, as in Grimme's dftd3 program."""
+
+PAIR_CUTOFF = 9000.0 ** 0.5
+"""float: default distance in bohr beyond which environment atoms are left out of
+a region-restricted calculation, the 2-body cutoff of Grimme's dftd3 program."""
@@ -42,11 +42,16 @@ Written by:  Rob Paton and Kelvin Jackson
 Last modified:  Mar 20, 2016
 """
 
+from collections import defaultdict
+from contextlib import redirect_stdout
 from functools import partial
 import multiprocessing as mp
 import json
+import sys
 from dataclasses import asdict
-from itertools import product
+from copy import copy
+from itertools import combinations_with_replacement, permutations, product
+from pathlib import Path
 from typing import List
 
 import jax.numpy as jnp
@@ -57,19 +62,36 @@ from prettytable import PrettyTable
 
 config.update("jax_enable_x64", True)
 
+from .cache import ParseCache
 from .ccParse import *
+from .checkpoint import DerivativeCheckpoint, checkpoint_key
 from .cli import cli
-from .constants import ALPHA6, ALPHA8, AU_TO_ANG, MAX_CONNECTIVITY, MAX_ELEMENTS
-from .jax_diff import derv, distribute
+from .constants import (
+    ALPHA6,
+    ALPHA8,
+    AU_TO_ANG,
+    BONDED_SCALING,
+    MAX_CONNECTIVITY,
+    MAX_ELEMENTS,
+    PAIR_CUTOFF,
+)
+from .jax_diff import derv, distribute, jvp_derv
+from .pairs import fragment_energies, packed_pair_energies
+from .parallel import evaluate, utilization_report
 from .parameters import C6AB, R2R4, RAB
 from .utils import (
     D3Configuration,
+    apply_sum_rules,
     check_inputs,
     der_order,
+    fragment_labels,
+    geometry_hash,
     getc6,
-    getMollist,
+    infer_bonds,
     lin,
     ncoord,
+    region_atoms,
+    topological_distances,
 )
 
 
@@ -77,11 +99,30 @@ def d3(
     config: "D3Configuration",
     charges_: List[float],
     *coordinates: float,
+    decomposition=None,
+    pairs=None,
 ):
     """The code has a faithful implementation of D3-zero and D3-BJ. There are
     also some optional parts that will selectively ignore or scale certain
     interatomic terms. Without these lines our ‘scalefactor’ is set to 1, which
     is equivalent to standard D3 terms.
+
+    If a dictionary is passed as ``decomposition``, it is filled with the
+    energy of each atom under ``"atoms"`` and the 2-body energies summed by
+    pair of atomic numbers ``(Za, Zb)``, ``Za <= Zb``, under
+    ``"element pairs"``. These are accumulated in the same loops as the
+    energy, which must not be traced for this. Each atom gets half of the
+    energy of each of its pairs and a third of that of each of its triples,
+    so that the atomic energies sum to the total.
+
+    Likewise, a dictionary passed as ``pairs`` is filled with the R^-6 and
+    R^-8 energies of each pair ``(j, k)``, ``j < k``, that enters the total.
+
+    With a region in ``config``, only the pairs with a region atom are
+    computed, with the environment atoms closer than ``config.region_cutoff``
+    (``PAIR_CUTOFF`` by default) to the region. The 3-body term then covers
+    only the triples with at least two region atoms, as the pairs of two
+    environment atoms are not computed.
     """
 
     # van der Waals attractive R^-6
@@ -91,6 +132,12 @@ def d3(
     # Axilrod-Teller-Muto 3-body repulsive
     repulsive_abc = 0.0
 
+    if decomposition is not None:
+        atom_energies = [0.0] * len(charges_)
+        element_pairs = defaultdict(float)
+        decomposition["atoms"] = atom_energies
+        decomposition["element pairs"] = element_pairs
+
     # not sure what this is...
     rs8 = 1.0
 
@@ -99,14 +146,28 @@ def d3(
     charges = [x - 1 for x in charges_]
 
     # In case something clever needs to be done wrt inter and intramolecular interactions
-    if config.bond_index is not None:
-        molAatoms = getMollist(config.bond_index, 0)
-        mols = []
-        for j in range(natom):
-            mols.append(0)
-            for atom in molAatoms:
-                if atom == j:
-                    mols[j] = 1
+    bond_index = config.bond_index
+    if bond_index is None and (config.intermolecular or config.bonded_scaling):
+        # no connectivity given: infer the bonds from the geometry. The
+        # derivative drivers pass them in instead, see with_bonds
+        bond_index = infer_bonds(charges_, coordinates)
+    if bond_index is not None:
+        mols = np.array(fragment_labels(bond_index))
+
+    # 'switch off' dispersion between bonded or geminal atoms, by topological distance
+    if config.bonded_scaling:
+        topology = topological_distances(bond_index)
+
+    # QM/MM-style region: only the pairs with a region atom are computed, and
+    # only the atoms of those pairs need coordination numbers
+    atoms = list(range(natom))
+    if config.region is not None:
+        region = np.unique(np.asarray(config.region, dtype=int))
+        cutoff = PAIR_CUTOFF if config.region_cutoff is None else config.region_cutoff
+        active = region_atoms(region, coordinates, cutoff)
+        in_region = np.zeros(natom, dtype=bool)
+        in_region[region] = True
+        atoms = active.tolist()
 
     mxc = [0]
     for j in range(MAX_ELEMENTS):
@@ -120,49 +181,39 @@ def d3(
                 break
 
     # Coordination number based on covalent radii
-    cn = ncoord(charges, coordinates)
+    if config.region is None:
+        cn = ncoord(charges, coordinates)
+    else:
+        cn = ncoord(charges, coordinates, atoms=atoms)
 
-    icomp = [0] * 100000
-    cc6ab = [0] * 100000
-    r2ab = [0] * 100000
-    dmp = [0] * 100000
+    # pair data for the 3-body term, keyed by lin(k, j), and the atoms k > j
+    # of the pairs computed for each atom j
+    cc6ab = {}
+    r2ab = {}
+    dmp = {}
+    computed = defaultdict(list)
 
-    for j in range(natom):
+    for j in atoms:
         dist = 0.0
         rr = 0.0
         attractive_r6_term = 0.0
         attractive_r8_term = 0.0
-        ## This could be used to 'switch off' dispersion between bonded or geminal atoms ##
-        scaling = False
-        for k in range(j + 1, natom):
+        if config.region is None:
+            partners = np.arange(j + 1, natom)
+        elif in_region[j]:
+            partners = active[active > j]
+        else:
+            partners = region[region > j]
+        if config.intermolecular and not config.threebody:
+            # only pairs with the atoms of other fragments are evaluated
+            partners = partners[mols[partners] != mols[j]]
+        for k in partners.tolist():
             scalefactor = 1.0
+            # intramolecular pairs are then only needed for the 3-body term
+            intramolecular = config.intermolecular and mols[j] == mols[k]
 
-            if config.intermolecular == True:
-                if mols[j] == mols[k]:
-                    scalefactor = 0
-                    print(f"   --- Ignoring interaction between atoms {j+1} and {k+1}")
-
-            if scaling and config.bond_index is not None:
-                if config.bond_index[j][k] == 1:
-                    scalefactor = 0
-                for l in range(natom):
-                    if (
-                        config.bond_index[j][l] != 0
-                        and config.bond_index[k][l] != 0
-                        and j != k
-                        and config.bond_index[j][k] == 0
-                    ):
-                        scalefactor = 0
-                    for m in range(natom):
-                        if (
-                            config.bond_index[j][l] != 0
-                            and config.bond_index[l][m] != 0
-                            and config.bond_index[k][m] != 0
-                            and j != m
-                            and k != l
-                            and config.bond_index[j][m] == 0
-                        ):
-                            scalefactor = 1 / 1.2
+            if config.bonded_scaling:
+                scalefactor = BONDED_SCALING.get(topology[j].get(k), 1.0)
 
             if k > j:
                 # compute distance
@@ -215,51 +266,65 @@ def d3(
                 else:
                     raise RuntimeError(f"{config.damp} is an unknown damping scheme.")
 
-                if config.pairwise and scalefactor != 0:
-                    print(
-                        f"   --- Pairwise interaction between atoms {j+1} and {k+1}: Edisp = {attractive_r6_term+attractive_r8_term:.6f} kcal/mol",
-                    )
+                if not intramolecular:
+                    attractive_r6_vdw += attractive_r6_term
+                    attractive_r8_vdw += attractive_r8_term
+
+                    if decomposition is not None:
+                        pair_term = float(attractive_r6_term + attractive_r8_term)
+                        atom_energies[j] += 0.5 * pair_term
+                        atom_energies[k] += 0.5 * pair_term
+                        elements = tuple(sorted((int(charges_[j]), int(charges_[k]))))
+                        element_pairs[elements] += pair_term
 
-                attractive_r6_vdw += attractive_r6_term
-                attractive_r8_vdw += attractive_r8_term
+                    if pairs is not None:
+                        pairs[j, k] = (
+                            float(attractive_r6_term),
+                            float(attractive_r8_term),
+                        )
 
                 if config.threebody:
                     jk = int(lin(k, j))
-                    icomp[jk] = 1
+                    computed[j].append(k)
                     cc6ab[jk] = jnp.sqrt(C6jk)
                     r2ab[jk] = jnp.power(dist, 2)
                     dmp[jk] = jnp.cbrt(1.0 / rr)
 
     if config.threebody:
         e63 = 0.0
-        for iat in range(natom):
-            for jat in range(natom):
+        for iat in atoms:
+            # partners are listed in increasing order, so that iat < jat < kat
+            partners = computed[iat]
+            for position, jat in enumerate(partners):
                 ij = int(lin(jat, iat))
-                if icomp[ij] == 1:
-                    for kat in range(jat, natom):
-                        ik = int(lin(kat, iat))
-                        jk = int(lin(kat, jat))
-
-                        if (
-                            kat > jat
-                            and jat > iat
-                            and icomp[ik] != 0
-                            and icomp[jk] != 0
-                        ):
-                            rav = (4.0 / 3.0) / (dmp[ik] * dmp[jk] * dmp[ij])
-                            tmp = 1.0 / (1.0 + 6.0 * rav ** ALPHA6)
-
-                            c9 = cc6ab[ij] * cc6ab[ik] * cc6ab[jk]
-                            d2 = [
-                                r2ab[ij],
-                                r2ab[jk],
-                                r2ab[ik],
-                            ]
-                            t1 = (d2[0] + d2[1] - d2[2]) / jnp.sqrt(d2[0] * d2[1])
-                            t2 = (d2[0] + d2[2] - d2[1]) / jnp.sqrt(d2[0] * d2[2])
-                            t3 = (d2[2] + d2[1] - d2[0]) / jnp.sqrt(d2[1] * d2[2])
-                            ang = 0.375 * t1 * t2 * t3 + 1.0
-                            e63 = e63 + tmp * c9 * ang / (d2[0] * d2[1] * d2[2]) ** 1.50
+                for kat in partners[position + 1 :]:
+                    ik = int(lin(kat, iat))
+                    jk = int(lin(kat, jat))
+
+                    if jk in cc6ab and not (
+                        config.intermolecular and mols[iat] == mols[jat] == mols[kat]
+                    ):
+                        rav = (4.0 / 3.0) / (dmp[ik] * dmp[jk] * dmp[ij])
+                        tmp = 1.0 / (1.0 + 6.0 * rav ** ALPHA6)
+
+                        c9 = cc6ab[ij] * cc6ab[ik] * cc6ab[jk]
+                        d2 = [
+                            r2ab[ij],
+                            r2ab[jk],
+                            r2ab[ik],
+                        ]
+                        t1 = (d2[0] + d2[1] - d2[2]) / jnp.sqrt(d2[0] * d2[1])
+                        t2 = (d2[0] + d2[2] - d2[1]) / jnp.sqrt(d2[0] * d2[2])
+                        t3 = (d2[2] + d2[1] - d2[0]) / jnp.sqrt(d2[1] * d2[2])
+                        ang = 0.375 * t1 * t2 * t3 + 1.0
+                        triple_term = tmp * c9 * ang / (d2[0] * d2[1] * d2[2]) ** 1.50
+                        e63 = e63 + triple_term
+
+                        if decomposition is not None:
+                            share = float(config.s6 * triple_term) / 3.0
+                            atom_energies[iat] += share
+                            atom_energies[jat] += share
+                            atom_energies[kat] += share
 
         repulsive_abc_term = config.s6 * e63
         repulsive_abc += repulsive_abc_term
@@ -267,6 +332,46 @@ def d3(
     return attractive_r6_vdw + attractive_r8_vdw + repulsive_abc
 
 
+def with_bonds(config, charges, coordinates):
+    """``config``, or a copy of it with the bonds inferred from the geometry if it needs them.
+
+    ``d3`` needs bonds with ``config.intermolecular`` or ``config.bonded_scaling``
+    and infers them itself if ``config.bond_index`` is None. Derivative
+    drivers infer them once beforehand instead of in every evaluation.
+    """
+    if config.bond_index is not None or not (
+        config.intermolecular or config.bonded_scaling
+    ):
+        return config
+
+    config = copy(config)
+    config.bond_index = infer_bonds(charges, coordinates)
+
+    return config
+
+
+def _frame_energy(frame, *, config):
+    index, step, charges, coordinates = frame
+    return index, step, float(d3(config, charges, *coordinates))
+
+
+def d3_frames(config, frames):
+    """D3 energies of a sequence of geometries, e.g. from ``iter_gaussian_frames``.
+
+    Parameters
+    ----------
+    config : D3Configuration
+    frames : iterable
+      Tuples of frame index, step number, charges and coordinates
+
+    Returns
+    -------
+    Generator of tuples of frame index, step number and D3 energy, in order.
+    The frames are distributed over ``config.nprocs`` processes.
+    """
+    return evaluate(partial(_frame_energy, config=config), iter(frames), config.nprocs)
+
+
 def D3_element_wise(elements, config, charges, *coordinates):
     """Driver for the calculation of chosen derivatives to arbitrary order.
 
@@ -282,6 +387,7 @@ def D3_element_wise(elements, config, charges, *coordinates):
     -------
     Derivative result for a given adress.
     """
+    config = with_bonds(config, charges, coordinates)
     dervs = []
     derivative_orders = []
     natoms = len(charges)
@@ -301,7 +407,34 @@ def D3_element_wise(elements, config, charges, *coordinates):
     return dervs
 
 
-def D3_derivatives(order, config, charges, *coordinates):
+def _derivative_component(component, *, num_variables, variables):
+    return derv(
+        2 * [0] + distribute(component, num_variables), fun=d3, variables=variables
+    )
+
+
+def completion_file(outfile):
+    """Path of the boolean mask of the computed entries of a streamed derivative tensor.
+
+    The mask is flat, in the order of ``tensor.reshape(-1)``, and next to
+    ``outfile``: ``gradient.npy`` has its mask in ``gradient.done.npy``.
+    """
+    outfile = Path(outfile)
+    return outfile.with_name(f"{outfile.stem}.done.npy")
+
+
+def D3_derivatives(
+    order,
+    config,
+    charges,
+    *coordinates,
+    sum_rules=False,
+    outfile=None,
+    checkpoint=None,
+    resume=False,
+    utilization=None,
+    sum_rule_check=None,
+):
     """Driver for the calculation of derivatives to arbitrary order.
 
     Parameters
@@ -311,144 +444,467 @@ def D3_derivatives(order, config, charges, *coordinates):
     config : D3Configuration
     charges : List[float]
     coordinates : float
+    sum_rules : bool
+      Only compute the derivatives for the first natoms-1 atoms and
+      reconstruct the entries of the last atom from the translational sum rules
+    outfile : str or Path
+      Stream the derivative tensor into a memory-mapped ``.npy`` file at this
+      path as the components are computed, instead of keeping it in memory.
+      Which entries have been computed is recorded alongside, in the boolean
+      ``.npy`` file given by ``completion_file``, so that the output of an
+      interrupted run can be told apart from a complete one
+    checkpoint : str or Path
+      Directory where completed components are periodically saved
+    resume : bool
+      Skip the components already saved in ``checkpoint`` by an earlier run
+      with the same configuration, geometry and order
+    utilization : dict
+      Filled with the utilization of the worker processes, as in ``evaluate``
+    sum_rule_check : dict
+      With ``sum_rules``, filled under ``"residual"`` with the largest
+      difference between a few reconstructed entries of the last atom and
+      their explicit evaluation, as a numerical-quality check
 
     Returns
     -------
-    Derivative tensor to desired order.
+    Derivative tensor to desired order, memory-mapped if ``outfile`` is given.
+    With ``config.region``, derivatives are only taken with respect to the
+    coordinates of the region atoms, in increasing order, and the tensor has
+    shape ``(nregion, 3) * order``.
     """
-    natoms = len(charges)
-    num_variables = 3 * natoms
+    config = with_bonds(config, charges, coordinates)
+    num_variables = 3 * len(charges)
+
+    # coordinates the derivatives are taken with respect to
+    if config.region is None:
+        natoms = len(charges)
+        variables = list(range(num_variables))
+    else:
+        if sum_rules:
+            raise RuntimeError("Sum rules need the derivatives of all atoms.")
+        region = np.unique(np.asarray(config.region, dtype=int))
+        natoms = len(region)
+        variables = (3 * region[:, None] + np.arange(3)).ravel().tolist()
+    shape = (natoms, 3) * order
+
+    if sum_rules:
+        if natoms < 2:
+            raise RuntimeError("Sum rules need at least two atoms.")
+        num_computed = 3 * (natoms - 1)
+    else:
+        num_computed = len(variables)
+
+    if outfile is None:
+        dervs = np.zeros(shape)
+    else:
+        dervs = np.lib.format.open_memmap(
+            outfile, mode="w+", dtype=float, shape=shape
+        )
+        computed = np.lib.format.open_memmap(
+            completion_file(outfile), mode="w+", dtype=bool, shape=(dervs.size,)
+        )
+    flat = dervs.reshape(-1)
+    strides = [len(variables) ** (order - 1 - slot) for slot in range(order)]
 
-    combo = product(range(num_variables), repeat=order)
-    derivative_orders = [distribute(x, num_variables) for x in combo]
-    d_jax = [2 * [0] + d for d in derivative_orders]
+    done = None
+    if checkpoint is not None:
+        key = checkpoint_key(
+            order, config, charges, coordinates, sum_rules=sum_rules
+        )
+        store = DerivativeCheckpoint(checkpoint, key, resume=resume)
+        addresses, values = store.load()
+        flat[addresses] = values
+        if outfile is not None:
+            computed[addresses] = True
+        done = np.zeros(flat.size, dtype=bool)
+        done[addresses] = True
+        if resume:
+            print(f"    - Resuming from {len(addresses)} checkpointed components\n")
+
+    def address(component):
+        return sum(c * s for c, s in zip(component, strides))
+
+    def pending():
+        for component in product(range(num_computed), repeat=order):
+            if done is None or not done[address(component)]:
+                yield component
 
     derivator = partial(
-        derv,
-        fun=d3,
+        _derivative_component,
+        num_variables=num_variables,
         variables=[config, charges, *coordinates],
     )
 
-    if config.nprocs > 1:
-        # split work evenly among the allotted processors
-        work_size = len(derivative_orders) // config.nprocs
-        with mp.Pool(processes=config.nprocs) as p:
-            result = p.map(
-                derivator,
-                d_jax,
-                chunksize=work_size,
-            )
-        dervs = np.array(result).reshape((natoms, 3) * order)
-    else:
-        it = (derivator(d) for d in d_jax)
-        dervs = np.fromiter(it, dtype=float, count=len(derivative_orders)).reshape(
-            (natoms, 3) * order
-        )
+    def tasks():
+        for component in pending():
+            yield tuple(variables[index] for index in component)
+
+    # results come back in task order, so a second pass over the components
+    # gives the address of each value
+    results = evaluate(derivator, tasks(), config.nprocs, utilization=utilization)
+    try:
+        for count, (value, component) in enumerate(zip(results, pending()), 1):
+            flat[address(component)] = value
+            if checkpoint is not None:
+                store.add(address(component), value)
+            if outfile is not None:
+                computed[address(component)] = True
+                if count % 4096 == 0:
+                    dervs.flush()
+                    computed.flush()
+    finally:
+        if checkpoint is not None:
+            store.flush()
+        if outfile is not None:
+            dervs.flush()
+            computed.flush()
+
+    if sum_rules:
+        apply_sum_rules(dervs)
+
+    if sum_rules and sum_rule_check is not None:
+        # compare a few reconstructed entries of the last atom against their
+        # explicit evaluation
+        residual = 0.0
+        for component in range(3):
+            entry = (natoms - 1, component) + (0, 0) * (order - 1)
+            explicit = derivator((3 * (natoms - 1) + component,) + (0,) * (order - 1))
+            residual = max(residual, abs(float(explicit) - dervs[entry]))
+        sum_rule_check["residual"] = residual
+
+    if outfile is not None:
+        dervs.flush()
+        computed[:] = True
+        computed.flush()
 
     return dervs
 
 
-def main():
-    # Takes arguments: (1) damping style, (2) s6, (3) rs6, (4) s8, (5) 3-body on/off, (6) input file(s)
-    args = cli()
+def _projected_component(indices, *, modes, config, charges, coordinates):
+    return jvp_derv(
+        [modes[i] for i in indices],
+        fun=lambda x: d3(config, charges, *x),
+        point=jnp.asarray(coordinates),
+    )
 
-    files = args.infiles
 
-    # prepare table of results
-    x = PrettyTable()
-    x.field_names = ["Input", "Total (au)"]
+def D3_projected_derivatives(order, modes, config, charges, *coordinates):
+    """Driver for the calculation of derivatives projected onto a set of displacements.
 
-    results = {f.stem: {"input": {}, "output": {}} for f in files}
-
-    for f in files:
-        extension = f.suffix
-        # parse Gaussian input files
-        if extension in [".com", ".gjf"]:
-            data = getinData(f)
-        # parse Gaussian output files
-        elif extension in [".out", ".log"]:
-            data = getoutData(f)
-        # parse PDB file
-        elif extension == ".pdb":
-            data = getpdbData(f)
-        # parse plain text file
-        elif extension == ".txt":
-            data = get_simple_data(f)
-        elif extension == ".json":
-            with open(f, "r") as j:
-                data = json.load(j)
-        else:
-            raise RuntimeError(f"Unrecognized file format {extension}")
-
-        functional = ""
-        if isinstance(data, dict):
-            charges = data["molecule"]["symbols"]
-            # reshape coordinates as (nat, 3) and convert to angstrom
-            coordinates = [[0.0, 0.0, 0.0] for _ in range(len(charges))]
-            for j in range(3):
-                for i in range(len(charges)):
-                    coordinates[i][j] = (
-                        data["molecule"]["geometry"][3 * i + j] * AU_TO_ANG
-                    )
-            functional = data["model"]["method"]
-        else:
-            charges = data.CHARGES
-            coordinates = data.CARTESIANS
-            functional = data.FUNCTIONAL
-
-        check_inputs(charges=charges, coordinates=coordinates)
-
-        config = D3Configuration(
-            functional=functional,
-            damp=args.damp,
-            nprocs=args.nprocs,
-            _s6=args.s6,
-            _rs6=args.rs6,
-            _s8=args.s8,
-            _a1=args.a1,
-            _a2=args.a2,
-            threebody=args.three,
-            intermolecular=args.inter,
-            pairwise=args.pairwise,
-        )
+    Parameters
+    ----------
+    order : int
+      Derivative order
+    modes : array_like
+      Displacement vectors, e.g. normal modes, one per row, each of length 3*natoms
+    config : D3Configuration
+    charges : List[float]
+    coordinates : float
+
+    Returns
+    -------
+    Projected derivative tensor of shape (nmodes,) * order.
+
+    Notes
+    -----
+    Only the symmetry-unique components are computed, each with nested
+    Jacobian-vector products, so the Cartesian tensor is never formed.
+    The displacement vectors are used as given, without mass-weighting.
+    """
+    config = with_bonds(config, charges, coordinates)
+    natoms = len(charges)
+    modes = np.asarray(modes, dtype=float).reshape(-1, 3 * natoms)
+    nmodes = modes.shape[0]
+
+    combo = list(combinations_with_replacement(range(nmodes), order))
+
+    projector = partial(
+        _projected_component,
+        modes=modes,
+        config=config,
+        charges=charges,
+        coordinates=coordinates,
+    )
+
+    dervs = np.zeros((nmodes,) * order)
+    results = evaluate(projector, iter(combo), config.nprocs)
+    for value, indices in zip(results, combo):
+        for address in set(permutations(indices)):
+            dervs[address] = value
+
+    return dervs
+
+
+MAX_RECORD_PAIRS = 10000
+"""int: number of pairs beyond which ``--pairwise`` energies are only written to ``.npy``."""
+
+
+def _tensor_output(tensor, binary):
+    """A tensor as nested lists, or the metadata of its ``.npy`` file."""
+    if binary is None:
+        return tensor.tolist()
+    return {"file": binary, "shape": list(tensor.shape), "dtype": str(tensor.dtype)}
+
+
+def _process_file(f, args):
+    """Parse one input file and compute its D3 energy and requested derivatives.
+
+    Parameters
+    ----------
+    f: Path
+      Input file.
+    args: argparse.Namespace
+      Parsed command-line arguments.
 
-        results[f.stem]["input"] = {
+    Returns
+    -------
+    f: Path
+      The input file.
+    total_vdw: float
+      D3 energy in hartree.
+    record: dict
+      The ``input`` and ``output`` sections of the results for this file.
+    """
+    extension = input_extension(f)
+    parser = None
+    # parse Gaussian input files
+    if extension in [".com", ".gjf"]:
+        parser = getinData
+    # parse Gaussian output files
+    elif extension in [".out", ".log"]:
+        parser = getoutData
+    # parse PDB file
+    elif extension == ".pdb":
+        parser = getpdbData
+    # parse mmCIF file
+    elif extension == ".cif":
+        parser = getcifData
+    # parse XYZ file
+    elif extension == ".xyz":
+        parser = getxyzData
+    # parse plain text file
+    elif extension == ".txt":
+        parser = get_simple_data
+    elif extension == ".json":
+        with open_input(f, "r") as j:
+            data = json.load(j)
+    else:
+        raise RuntimeError(f"Unrecognized file format {extension}")
+
+    if parser is not None and args.cache is not None:
+        data = ParseCache(args.cache).parse(f, parser)
+    elif parser is not None:
+        data = parser(f)
+
+    functional = ""
+    if isinstance(data, dict):
+        # QCSchema molecule: element symbols and flat geometry in bohr
+        symbols = data["molecule"]["symbols"]
+        charges = [qcel.periodictable.to_Z(symbol) for symbol in symbols]
+        coordinates = list(data["molecule"]["geometry"])
+        functional = data["model"]["method"]
+    else:
+        charges = data.CHARGES
+        coordinates = data.CARTESIANS
+        functional = data.FUNCTIONAL
+
+    check_inputs(charges=charges, coordinates=coordinates)
+
+    config = D3Configuration(
+        functional=functional,
+        damp=args.damp,
+        nprocs=args.nprocs,
+        _s6=args.s6,
+        _rs6=args.rs6,
+        _s8=args.s8,
+        _a1=args.a1,
+        _a2=args.a2,
+        threebody=args.three,
+        # connectivity of Gaussian inputs; the energy only depends on it with
+        # --inter or --bonded-scaling
+        bond_index=getattr(data, "BONDINDEX", None),
+        intermolecular=args.inter,
+        bonded_scaling=args.bonded_scaling,
+        region=args.region,
+        region_cutoff=(
+            None if args.region_cutoff is None else args.region_cutoff / AU_TO_ANG
+        ),
+    )
+
+    # bonds are inferred here once, if needed, rather than in every d3 call
+    config = with_bonds(config, charges, coordinates)
+
+    record = {
+        "input": {
             "molecule": qcel.molparse.from_arrays(
                 geom=coordinates, elez=charges, np_out=False
             ),
             "config": asdict(config),
+        },
+    }
+
+    # the decomposition and pair energies are accumulated during the energy evaluation
+    decomposition = {} if args.decompose else None
+    pairs = {} if args.pairwise else None
+    total_vdw = d3(
+        config,
+        charges,
+        *coordinates,
+        decomposition=decomposition,
+        pairs=pairs,
+    )
+
+    record["output"] = {
+        "D3 energy (au)": float(total_vdw),
+    }
+
+    if args.fragments:
+        bond_index = config.bond_index
+        if bond_index is None:
+            bond_index = infer_bonds(charges, coordinates)
+        labels = fragment_labels(bond_index)
+        matrix = fragment_energies(config, charges, coordinates, labels)
+        record["output"]["Fragments"] = labels
+        record["output"]["Fragment interaction energies (au)"] = matrix.tolist()
+
+    if args.decompose:
+        record["output"]["Atomic energies (au)"] = decomposition["atoms"]
+        record["output"]["Element pair energies (au)"] = {
+            f"{qcel.periodictable.to_E(za)}-{qcel.periodictable.to_E(zb)}": energy
+            for (za, zb), energy in sorted(decomposition["element pairs"].items())
         }
 
-        total_vdw = d3(
+    if args.pairwise:
+        pairs = packed_pair_energies(pairs, len(charges))
+        pairs_file = None
+        # large matrices are always written to .npy rather than into the record
+        if args.binary or len(pairs) > MAX_RECORD_PAIRS:
+            pairs_file = f"{input_stem(f)}_pairs.npy"
+            np.save(pairs_file, pairs)
+        record["output"]["Pair energies (au)"] = _tensor_output(pairs, pairs_file)
+
+    frame_readers = {
+        ".out": iter_gaussian_frames,
+        ".log": iter_gaussian_frames,
+        ".xyz": iter_xyz_frames,
+        ".pdb": iter_pdb_frames,
+        ".cif": iter_cif_frames,
+    }
+    if args.frames and extension in frame_readers:
+        frames = frame_readers[extension](f)
+        record["output"]["frames"] = [
+            {"frame": index, "step": step, "D3 energy (au)": energy}
+            for index, step, energy in d3_frames(config, frames)
+        ]
+
+    # derivative tensors can be written to .npy, with only their metadata in the record
+    binary = f"{input_stem(f)}.npy" if args.binary and args.order > 0 else None
+    if binary is not None:
+        record["input"]["geometry_hash"] = geometry_hash(charges, coordinates)
+
+    if args.order > 0 and args.modes:
+        modes = getattr(data, "NORMALMODES", None)
+        if not modes:
+            raise RuntimeError(f"No normal modes found in {f}")
+        d3_diff = D3_projected_derivatives(
+            args.order,
+            modes,
+            config,
+            charges,
+            *coordinates,
+        )
+        if binary is not None:
+            np.save(binary, d3_diff)
+
+        key = f"{der_order(args.order)} order normal-mode derivative"
+        record["output"][key] = _tensor_output(d3_diff, binary)
+    elif args.order > 0:
+        utilization = {} if args.verbose > 1 else None
+        sum_rule_check = {} if args.sum_rules else None
+        d3_diff = D3_derivatives(
+            args.order,
             config,
             charges,
             *coordinates,
+            sum_rules=args.sum_rules,
+            outfile=binary,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            utilization=utilization,
+            sum_rule_check=sum_rule_check,
         )
+        if utilization:
+            print(utilization_report(utilization))
+        if sum_rule_check:
+            residual = sum_rule_check["residual"]
+            print(f"    - Translational sum rule residual: {residual:.3e}\n")
 
-        results[f.stem]["output"] = {
-            "D3 energy (au)": float(total_vdw),
-        }
+        key = f"{der_order(args.order)} order geometric derivative"
+        record["output"][key] = _tensor_output(d3_diff, binary)
+
+    return f, float(total_vdw), record
+
+
+def _process_file_quietly(f, args):
+    # keeps stdout free for the JSON Lines stream
+    with redirect_stdout(sys.stderr):
+        return _process_file(f, args)
+
+
+def main():
+    # Takes arguments: (1) damping style, (2) s6, (3) rs6, (4) s8, (5) 3-body on/off, (6) input file(s)
+    args = cli()
 
-        if args.order > 0:
-            d3_diff = D3_derivatives(
-                args.order,
-                config,
-                charges,
-                *coordinates,
-            )
+    files = args.infiles
 
-            results[f.stem]["output"] = {
-                f"{der_order(args.order)} order geometric derivative": d3_diff.tolist(),
-            }
+    # worker processes cannot start pools of their own
+    if args.jobs > 1:
+        if args.nprocs > 1:
+            raise RuntimeError("--jobs and --nprocs cannot both be above 1.")
+        args.nprocs = 1
 
-        with open(f"{f.stem}.json", "w") as o:
-            json.dump(results, o, indent=2)
+    # the packed pair matrix covers all pairs, not only those of a region
+    if args.pairwise and args.region is not None:
+        raise RuntimeError("--pairwise cannot be combined with --region.")
 
-        # convert to atomic units for final printout
-        row = [f, total_vdw]
-        x.add_row(row)
+    # prepare table of results
+    x = PrettyTable()
+    x.field_names = ["Input", "Total (au)"]
 
-    print(x)
+    # one compact record per structure, written as soon as it is computed
+    stream = None
+    worker = _process_file
+    if args.jsonl == "-":
+        stream = sys.stdout
+        worker = _process_file_quietly
+    elif args.jsonl is not None:
+        stream = open(args.jsonl, "w")
+
+    jobs = evaluate(
+        partial(worker, args=args),
+        iter(files),
+        args.jobs,
+        ordered=not args.unordered,
+    )
+    with redirect_stdout(sys.stderr if stream is sys.stdout else sys.stdout):
+        for f, total_vdw, record in jobs:
+            if stream is not None:
+                record = {"name": input_stem(f), "file": str(f), **record}
+                stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+                stream.flush()
+                continue
+
+            with open(f"{input_stem(f)}.json", "w") as o:
+                json.dump({input_stem(f): record}, o, indent=2)
+
+            # convert to atomic units for final printout
+            row = [f, total_vdw]
+            x.add_row(row)
+
+    if stream is None:
+        print(x)
+    elif stream is not sys.stdout:
+        stream.close()
 
 
 if __name__ == "__main__":
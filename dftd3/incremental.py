@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+#
+
+"""Incremental D3 energies of structures in which a few atoms move at a time."""
+
+import numpy as np
+
+from .constants import CN_CUTOFF, PAIR_CUTOFF
+from .pairs import (
+    bonded_pairs,
+    counting_function,
+    intermolecular_labels,
+    neighbor_pairs,
+    pair_energies,
+    scale_factors,
+)
+
+
+class IncrementalD3:
+    """D3 energy of a structure updated atom move by atom move.
+
+    The energies of the pairs closer than ``cutoff`` and the coordination
+    numbers are stored, as lists of neighbours and pair energies for each
+    atom. When some atoms move, the contributions of the moved atoms to the
+    coordination numbers are replaced, and only the pairs of the moved atoms
+    and of the atoms whose coordination number changed by more than
+    ``cn_threshold`` are recomputed. The cost of a move is proportional to
+    the number of these pairs, instead of the square of the number of atoms.
+
+    As in region calculations, coordination numbers only count the atoms
+    closer than ``CN_CUTOFF`` and pairs farther apart than ``cutoff`` are
+    left out, so that for structures larger than these cutoffs the energy
+    differs slightly from that of ``d3``.
+
+    Coordination numbers fall off exponentially with distance, so that a move
+    changes those of the atoms far away by tiny amounts. The stored pair
+    energies of such an atom are kept until its coordination number has moved
+    by more than ``cn_threshold`` from the one they were computed with; with
+    ``cn_threshold=0.0`` the energy is the same as from ``d3`` within the
+    cutoffs.
+
+    The 3-body term is not supported. ``config.intermolecular`` and
+    ``config.bonded_scaling`` are, with the fragments and bonds of the
+    initial structure.
+
+    Parameters
+    ----------
+    config: D3Configuration
+    charges: List[int]
+      Atomic numbers.
+    coordinates: List[float]
+      Flat list of Cartesian coordinates, in bohr.
+    cn_threshold: float
+      Change in coordination number above which the pairs of an atom are
+      recomputed.
+    cutoff: float
+      Distance in bohr beyond which pairs are left out.
+    block_size: int
+      At most ``block_size**2`` pairs are evaluated at once, to bound memory.
+
+    Attributes
+    ----------
+    energy: float
+      Current D3 energy, in hartree.
+    xyz: np.ndarray
+      Current Cartesian coordinates in bohr, shape ``(natoms, 3)``.
+    cn: np.ndarray
+      Current coordination numbers.
+    """
+
+    def __init__(
+        self,
+        config,
+        charges,
+        coordinates,
+        cn_threshold=1.0e-6,
+        cutoff=PAIR_CUTOFF,
+        block_size=1024,
+    ):
+        if config.threebody:
+            raise RuntimeError("The 3-body term is not supported by IncrementalD3.")
+
+        self.config = config
+        self.cn_threshold = cn_threshold
+        self.cutoff = cutoff
+        self.block_size = block_size
+        self.charges = np.asarray(charges, dtype=int) - 1
+        self.xyz = np.array(coordinates, dtype=float).reshape(-1, 3)
+        atoms = np.arange(len(self.charges))
+
+        self._scaled = None
+        if config.bonded_scaling:
+            self._scaled = bonded_pairs(config, charges, coordinates)
+        self._labels = intermolecular_labels(config, charges, coordinates)
+
+        i, j = neighbor_pairs(self.xyz, atoms, CN_CUTOFF)
+        self.cn = np.bincount(
+            i,
+            weights=counting_function(self.charges, self.xyz, i, j),
+            minlength=len(atoms),
+        )
+        # coordination numbers the stored pair energies were computed with
+        self._cn_used = self.cn.copy()
+
+        # neighbours and pair energies of each atom; every pair is in two lists
+        self._neighbors, self._energies = self._rows(self._cn_used, self.xyz, atoms)
+        self.energy = 0.5 * float(sum(energies.sum() for energies in self._energies))
+
+    def _pair_energies(self, cn, xyz, i, j):
+        # energies of the pairs (i, j), always evaluated as (min, max) so
+        # that both lists of a pair hold the same energy
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        e6, e8 = pair_energies(self.config, self.charges, xyz, cn, i, j)
+        energies = e6 + e8
+        if self._scaled is not None:
+            energies = energies * scale_factors(self._scaled, len(self.charges), i, j)
+        if self._labels is not None:
+            energies = np.where(self._labels[i] != self._labels[j], energies, 0.0)
+
+        return energies
+
+    def _rows(self, cn, xyz, atoms):
+        # neighbours within the cutoff of each of atoms and their pair energies
+        i, j = neighbor_pairs(xyz, atoms, self.cutoff)
+        energies = np.zeros(len(i))
+        for start in range(0, len(i), self.block_size**2):
+            block = slice(start, start + self.block_size**2)
+            energies[block] = self._pair_energies(cn, xyz, i[block], j[block])
+
+        splits = np.cumsum(np.bincount(np.searchsorted(atoms, i), minlength=len(atoms)))
+        neighbors = np.split(j.astype(np.int32), splits[:-1])
+
+        return neighbors, np.split(energies, splits[:-1])
+
+    def _step(self, atoms, coordinates):
+        atoms = np.asarray(atoms, dtype=int).reshape(-1)
+        if len(np.unique(atoms)) != len(atoms):
+            raise RuntimeError("Each moved atom must be given only once.")
+
+        xyz = self.xyz.copy()
+        xyz[atoms] = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+
+        # contributions of the moved atoms to the coordination numbers, before
+        # and after the move
+        i, j = neighbor_pairs(self.xyz, atoms, CN_CUTOFF)
+        old = counting_function(self.charges, self.xyz, i, j)
+        cn = self.cn - np.bincount(j, weights=old, minlength=len(self.cn))
+        i, j = neighbor_pairs(xyz, atoms, CN_CUTOFF)
+        new = counting_function(self.charges, xyz, i, j)
+        cn += np.bincount(j, weights=new, minlength=len(self.cn))
+        cn[atoms] = np.bincount(i, weights=new, minlength=len(self.cn))[atoms]
+
+        stale = np.flatnonzero(np.abs(cn - self._cn_used) > self.cn_threshold)
+        affected = np.union1d(atoms, stale)
+        cn_used = self._cn_used.copy()
+        cn_used[affected] = cn[affected]
+
+        neighbors, energies = self._rows(cn_used, xyz, affected)
+
+        def total(neighbors, energies):
+            # pairs among the affected atoms are in two lists
+            total = 0.0
+            for partners, row in zip(neighbors, energies):
+                total += row.sum() - 0.5 * row[np.isin(partners, affected)].sum()
+            return total
+
+        delta = total(neighbors, energies) - total(
+            [self._neighbors[atom] for atom in affected],
+            [self._energies[atom] for atom in affected],
+        )
+
+        return float(delta), (xyz, cn, cn_used, affected, neighbors, energies)
+
+    def delta(self, atoms, coordinates):
+        """Change of the D3 energy if ``atoms`` moved to ``coordinates``, without moving them.
+
+        Parameters
+        ----------
+        atoms: List[int]
+          Indices of the moved atoms.
+        coordinates: List[float]
+          New Cartesian coordinates of the moved atoms in bohr, flat or of
+          shape ``(len(atoms), 3)``.
+
+        Returns
+        -------
+        Energy change, in hartree.
+        """
+
+        return self._step(atoms, coordinates)[0]
+
+    def move(self, atoms, coordinates):
+        """Move ``atoms`` to ``coordinates`` and update the energy.
+
+        Parameters are as for ``delta``.
+
+        Returns
+        -------
+        Energy change, in hartree.
+        """
+
+        delta, (xyz, cn, cn_used, affected, neighbors, energies) = self._step(
+            atoms, coordinates
+        )
+
+        # the pairs of the affected atoms in the lists of the other atoms:
+        # the old ones are dropped and the new ones added
+        old = [self._neighbors[atom] for atom in affected]
+        counts = [len(partners) for partners in neighbors]
+        i = np.concatenate(neighbors + [np.zeros(0, dtype=np.int32)])
+        j = np.repeat(affected, counts).astype(np.int32)
+        added = np.concatenate(energies + [np.zeros(0)])
+        outside = ~np.isin(i, affected)
+        i, j, added = i[outside], j[outside], added[outside]
+        order = np.argsort(i, kind="stable")
+        i, j, added = i[order], j[order], added[order]
+
+        touched = np.union1d(np.concatenate(old + [np.zeros(0, dtype=np.int32)]), i)
+        touched = np.setdiff1d(touched, affected)
+        starts = np.searchsorted(i, touched, side="left")
+        ends = np.searchsorted(i, touched, side="right")
+        for atom, start, end in zip(touched.tolist(), starts, ends):
+            partners = self._neighbors[atom]
+            kept = ~np.isin(partners, affected)
+            partners = np.concatenate([partners[kept], j[start:end]])
+            row = np.concatenate([self._energies[atom][kept], added[start:end]])
+            order = np.argsort(partners, kind="stable")
+            self._neighbors[atom] = partners[order]
+            self._energies[atom] = row[order]
+
+        for atom, partners, row in zip(affected.tolist(), neighbors, energies):
+            self._neighbors[atom] = partners
+            self._energies[atom] = row
+
+        self.xyz = xyz
+        self.cn = cn
+        self._cn_used = cn_used
+        self.energy += delta
+
+        return delta
@@ -1,4 +1,4 @@
-from jax import grad
+from jax import grad, jvp
 from jax.config import config
 
 config.update("jax_enable_x64", True)
@@ -26,6 +26,27 @@ def derv(orders, *, fun, variables) -> float:
     return functions[-1](*variables)
 
 
+def _directional(fun, direction):
+    def tangent(x):
+        return jvp(fun, (x,), (direction,))[1]
+
+    return tangent
+
+
+def jvp_derv(directions, *, fun, point) -> float:
+    """
+    fun: function to differentiate which expects a single array argument
+    point: array at which to differentiate the function
+    directions: [v1, v2, v3] means differentiate along v1, then v2, then v3,
+                that is the directional derivative D^3 fun(point)[v1, v2, v3].
+    Forward-mode only: no intermediate of size len(point)**order is formed.
+    """
+    functions = [fun]
+    for i, direction in enumerate(directions):
+        functions.append(_directional(functions[i], direction))
+    return functions[-1](point)
+
+
 def distribute(indices, num_variables):
     l = [0 for _ in range(num_variables)]
     for index in indices:
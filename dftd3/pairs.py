@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+#
+
+"""Vectorized D3 pair terms.
+
+The functions in this module evaluate the same coordination numbers, C6
+coefficients and damped R^-6 and R^-8 pair energies as ``d3``, on arrays of
+atom pairs with NumPy instead of one pair at a time. Pairs are processed in
+chunks of a fixed size, so that memory stays bounded for large systems. They are not
+differentiable; use ``d3`` and ``D3_derivatives`` for derivatives.
+"""
+
+import numpy as np
+
+from .constants import (
+    ALPHA6,
+    ALPHA8,
+    AU_TO_ANG,
+    BONDED_SCALING,
+    MAX_CONNECTIVITY,
+    MAX_ELEMENTS,
+)
+from .parameters import C6AB, R2R4, RAB, RCOV
+from .utils import (
+    fragment_labels,
+    infer_bonds,
+    neighbor_lists,
+    topological_distances,
+)
+
+_TABLES = None
+"""Tuple[np.ndarray]: reference C6, their coordination numbers and fallback C6."""
+
+
+def _tables():
+    # the C6AB nested lists as dense arrays, built on first use. Only the
+    # first mxc references of each element are used, as in d3 and getc6; the
+    # weight of an unused reference is zero through its infinite CN.
+    global _TABLES
+
+    if _TABLES is None:
+        shape = (MAX_ELEMENTS, MAX_ELEMENTS, MAX_CONNECTIVITY, MAX_CONNECTIVITY)
+        c6 = np.zeros(shape)
+        cna = np.full(shape, np.inf)
+        cnb = np.full(shape, np.inf)
+        fallback = np.zeros(shape[:2])
+
+        mxc = []
+        for element in range(MAX_ELEMENTS):
+            references = C6AB[element][element]
+            mxc.append(
+                sum(
+                    isinstance(references[l][l], (list, tuple))
+                    and references[l][l][0] > 0
+                    for l in range(MAX_CONNECTIVITY)
+                )
+            )
+
+        for a in range(MAX_ELEMENTS):
+            for b in range(MAX_ELEMENTS):
+                for i in range(mxc[a]):
+                    for j in range(mxc[b]):
+                        reference = C6AB[a][b][i][j]
+                        if isinstance(reference, (list, tuple)) and reference[0] > 0:
+                            c6[a, b, i, j], cna[a, b, i, j], cnb[a, b, i, j] = reference
+                            fallback[a, b] = reference[0]
+
+        _TABLES = (c6, cna, cnb, fallback)
+
+    return _TABLES
+
+
+def pair_blocks(natoms, block_size=1024):
+    """Yield the pairs ``i < j`` of ``natoms`` atoms as index arrays, by chunks.
+
+    Pairs come in the order of ``np.triu_indices(natoms, k=1)``, at most
+    ``block_size**2`` at a time whatever the number of atoms.
+    """
+
+    npairs = natoms * (natoms - 1) // 2
+    # position of the first pair of each row in the packed upper triangle
+    rows = np.arange(natoms)
+    starts = rows * (2 * natoms - rows - 1) // 2
+    for start in range(0, npairs, block_size**2):
+        pairs = np.arange(start, min(start + block_size**2, npairs))
+        i = np.searchsorted(starts, pairs, side="right") - 1
+        yield i, pairs - starts[i] + i + 1
+
+
+def row_blocks(natoms, block_size=1024):
+    """Yield the atoms by blocks of rows of at most ``block_size**2`` pairs with all atoms."""
+
+    step = max(1, block_size**2 // max(natoms, 1))
+    for start in range(0, natoms, step):
+        yield np.arange(start, min(start + step, natoms))
+
+
+def neighbor_pairs(xyz, atoms, cutoff):
+    """Pairs of ``atoms`` with the atoms closer than ``cutoff``, from ``neighbor_lists``.
+
+    Parameters
+    ----------
+    xyz: np.ndarray
+      Cartesian coordinates in bohr, shape ``(natoms, 3)``.
+    atoms: np.ndarray
+      Atoms whose pairs are listed.
+    cutoff: float
+      Distance in bohr.
+
+    Returns
+    -------
+    Tuple of the index arrays ``i`` and ``j`` of the pairs, sorted by atom of
+    ``atoms`` and then by neighbour.
+    """
+
+    atoms = np.asarray(atoms, dtype=int)
+    neighbors = neighbor_lists(xyz.ravel(), atoms, cutoff)
+    i = np.repeat(atoms, [len(partners) for partners in neighbors])
+    j = np.concatenate(neighbors + [np.zeros(0, dtype=int)]).astype(int)
+
+    return i, j
+
+
+def counting_function(charges, xyz, i, j, k1=16, k2=4 / 3):
+    """Contributions of the pairs ``(i, j)``, ``i != j``, to the coordination numbers, as in ``ncoord``."""
+
+    rcov = np.asarray(RCOV)
+    r = np.linalg.norm(xyz[i] - xyz[j], axis=-1) * AU_TO_ANG
+    rco = k2 * (rcov[charges[i]] + rcov[charges[j]])
+
+    return 1.0 / (1.0 + np.exp(-k1 * (rco / r - 1.0)))
+
+
+def cn_contributions(charges, xyz, rows, k1=16, k2=4 / 3):
+    """Counting function between the atoms ``rows`` and all atoms, as in ``ncoord``.
+
+    Returns an array of shape ``(len(rows), natoms)``, zero for an atom and
+    itself, whose row sums are the coordination numbers of ``rows``.
+    """
+    xyz = xyz * AU_TO_ANG
+    rcov = np.asarray(RCOV)[charges]
+
+    r = np.linalg.norm(xyz[rows, None] - xyz[None], axis=-1)
+    rco = k2 * (rcov[rows, None] + rcov[None])
+    with np.errstate(divide="ignore"):
+        damp = 1.0 / (1.0 + np.exp(-k1 * (rco / r - 1.0)))
+    damp[np.arange(len(rows)), rows] = 0.0
+
+    return damp
+
+
+def coordination_numbers(charges, xyz, k1=16, k2=4 / 3, block_size=1024):
+    """Coordination numbers of all atoms, as in ``ncoord``.
+
+    Parameters
+    ----------
+    charges: np.ndarray
+      Atomic numbers minus one, as used for indexing in ``d3``.
+    xyz: np.ndarray
+      Cartesian coordinates in bohr, shape ``(natoms, 3)``.
+    """
+    cn = np.zeros(len(charges))
+
+    for rows in row_blocks(len(charges), block_size):
+        cn[rows] = cn_contributions(charges, xyz, rows, k1, k2).sum(axis=1)
+
+    return cn
+
+
+def c6_coefficients(charges, cn, i, j, k3=-4.0):
+    """C6 coefficients of the pairs ``(i, j)``, interpolated as in ``getc6``."""
+
+    c6, cna, cnb, fallback = _tables()
+    a = charges[i]
+    b = charges[j]
+    cni = cn[i]
+    cnj = cn[j]
+
+    # one reference pair at a time, so that temporaries have one entry per pair
+    rsum = np.zeros(len(a))
+    csum = np.zeros(len(a))
+    for k in range(MAX_CONNECTIVITY):
+        for l in range(MAX_CONNECTIVITY):
+            r = (cna[a, b, k, l] - cni) ** 2 + (cnb[a, b, k, l] - cnj) ** 2
+            weights = np.exp(k3 * r)
+            rsum += weights
+            csum += weights * c6[a, b, k, l]
+
+    return np.where(rsum > 0, csum / np.where(rsum > 0, rsum, 1.0), fallback[a, b])
+
+
+def bonded_pairs(config, charges, coordinates):
+    """Pairs scaled by ``BONDED_SCALING`` and their scale factors.
+
+    The bonds are taken from ``config.bond_index``, or inferred from the
+    geometry. Only pairs at most 3 bonds apart are kept, so the table is
+    sparse.
+
+    Returns
+    -------
+    Tuple of the sorted keys ``i * natoms + j`` of the pairs ``i < j`` and
+    their scale factors, as arrays.
+    """
+
+    bond_index = config.bond_index
+    if bond_index is None:
+        bond_index = infer_bonds(charges, coordinates)
+
+    natoms = len(bond_index)
+    table = {
+        i * natoms + j: BONDED_SCALING[depth]
+        for i, partners in enumerate(topological_distances(bond_index))
+        for j, depth in partners.items()
+        if i < j
+    }
+    keys = np.array(sorted(table), dtype=np.int64)
+
+    return keys, np.array([table[key] for key in keys.tolist()], dtype=float)
+
+
+def scale_factors(scaled, natoms, i, j):
+    """Scale factors of the pairs ``(i, j)``, ``i < j``, from ``bonded_pairs``."""
+
+    keys, factors = scaled
+    pairs = i * natoms + j
+    scale = np.ones(len(pairs))
+    if len(keys):
+        where = np.minimum(np.searchsorted(keys, pairs), len(keys) - 1)
+        found = keys[where] == pairs
+        scale[found] = factors[where[found]]
+
+    return scale
+
+
+def damped_terms(config, charges, xyz, i, j):
+    """Damped R^-6 and R^-8 pair energies per unit C6 of the pairs ``(i, j)``.
+
+    Both damping schemes of ``d3`` use a ratio C8/C6 fixed by the elements,
+    so the pair energies are the C6 coefficient times terms that only depend
+    on the distance. The arguments are as for ``pair_energies``, without the
+    coordination numbers.
+
+    Returns
+    -------
+    Tuple of the R^-6 and R^-8 terms, such that ``e6 = c6 * g6`` and
+    ``e8 = c6 * g8``.
+    """
+
+    # not sure what this is... (as in d3)
+    rs8 = 1.0
+
+    dist = np.linalg.norm(xyz[i] - xyz[j], axis=-1)
+    a = charges[i]
+    b = charges[j]
+    r2r4 = np.asarray(R2R4)
+    # C8 / C6
+    q = 3.0 * r2r4[a] * r2r4[b]
+
+    if config.damp.casefold() == "zero".casefold():
+        rr = np.asarray(RAB)[a, b] / dist
+        damp6 = 1 / (1 + 6 * np.power(config.rs6 * rr, ALPHA6))
+        damp8 = 1 / (1 + 6 * np.power(rs8 * rr, ALPHA8))
+        g6 = -config.s6 * damp6 / np.power(dist, 6)
+        g8 = -config.s8 * q * damp8 / np.power(dist, 8)
+    elif config.damp.casefold() == "bj".casefold():
+        rr = np.sqrt(q)
+        tmp = config.a1 * rr + config.a2
+        g6 = -config.s6 / (np.power(dist, 6) + np.power(tmp, 6))
+        g8 = -config.s8 * q / (np.power(dist, 8) + np.power(tmp, 8))
+    else:
+        raise RuntimeError(f"{config.damp} is an unknown damping scheme.")
+
+    return g6, g8
+
+
+def pair_energies(config, charges, xyz, cn, i, j):
+    """Damped R^-6 and R^-8 dispersion energies of the pairs ``(i, j)``, as in ``d3``.
+
+    Parameters
+    ----------
+    config: D3Configuration
+    charges: np.ndarray
+      Atomic numbers minus one.
+    xyz: np.ndarray
+      Cartesian coordinates in bohr, shape ``(natoms, 3)``.
+    cn: np.ndarray
+      Coordination numbers, from ``coordination_numbers``.
+    i, j: np.ndarray
+      Atom indices of the pairs.
+
+    Returns
+    -------
+    Tuple of the R^-6 and R^-8 energies of the pairs, in hartree.
+    """
+
+    g6, g8 = damped_terms(config, charges, xyz, i, j)
+    c6 = c6_coefficients(charges, cn, i, j)
+
+    return c6 * g6, c6 * g8
+
+
+def intermolecular_labels(config, charges, coordinates):
+    """Fragment of each atom with ``config.intermolecular``, otherwise None."""
+
+    if not config.intermolecular:
+        return None
+
+    bond_index = config.bond_index
+    if bond_index is None:
+        bond_index = infer_bonds(charges, coordinates)
+
+    return np.asarray(fragment_labels(bond_index))
+
+
+def iter_pair_energies(config, charges, coordinates, block_size=1024):
+    """Yield the R^-6 and R^-8 energies of all pairs ``i < j``, by chunks.
+
+    Pairs are scaled as in ``d3`` if ``config.bonded_scaling`` is set; all
+    other options of ``config`` beyond the damping are ignored.
+
+    Parameters
+    ----------
+    config: D3Configuration
+    charges: List[int]
+      Atomic numbers.
+    coordinates: List[float]
+      Flat list of Cartesian coordinates, in bohr.
+    block_size: int
+      At most ``block_size**2`` pairs are evaluated at once, to bound memory.
+
+    Yields
+    ------
+    Tuples of the atom indices ``i`` and ``j`` and the R^-6 and R^-8 energies
+    of the pairs of a chunk, as arrays. Chunks follow each other in the order
+    of ``np.triu_indices(natoms, k=1)``.
+    """
+
+    scaled = None
+    if config.bonded_scaling:
+        scaled = bonded_pairs(config, charges, coordinates)
+
+    charges = np.asarray(charges, dtype=int) - 1
+    xyz = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    cn = coordination_numbers(charges, xyz)
+
+    for i, j in pair_blocks(len(charges), block_size):
+        e6, e8 = pair_energies(config, charges, xyz, cn, i, j)
+        if scaled is not None:
+            scale = scale_factors(scaled, len(charges), i, j)
+            e6 = e6 * scale
+            e8 = e8 * scale
+        yield i, j, e6, e8
+
+
+def pair_energy_matrix(config, charges, coordinates, block_size=1024):
+    """Packed matrix of the D3 pair energies.
+
+    With ``config.intermolecular``, pairs within a fragment are zero. The
+    fragments come from ``config.bond_index``, or from bonds inferred from
+    the geometry.
+
+    Parameters
+    ----------
+    config: D3Configuration
+    charges: List[int]
+      Atomic numbers.
+    coordinates: List[float]
+      Flat list of Cartesian coordinates, in bohr.
+
+    Returns
+    -------
+    Array of shape ``(natoms * (natoms - 1) // 2, 3)``, in hartree, with the
+    R^-6, R^-8 and total energy of each pair ``i < j``. Pairs are in the order
+    of ``np.triu_indices(natoms, k=1)``, so that e.g. the symmetric matrix of
+    total energies is ``m[np.triu_indices(natoms, k=1)] = energies[:, 2]``
+    followed by ``m += m.T``.
+    """
+
+    natoms = len(charges)
+    energies = np.zeros((natoms * (natoms - 1) // 2, 3))
+
+    labels = intermolecular_labels(config, charges, coordinates)
+
+    start = 0
+    for i, j, e6, e8 in iter_pair_energies(config, charges, coordinates, block_size):
+        if labels is not None:
+            e6 = np.where(labels[i] != labels[j], e6, 0.0)
+            e8 = np.where(labels[i] != labels[j], e8, 0.0)
+        block = energies[start : start + len(i)]
+        block[:, 0] = e6
+        block[:, 1] = e8
+        block[:, 2] = e6 + e8
+        start += len(i)
+
+    return energies
+
+
+def packed_pair_energies(pairs, natoms):
+    """Packed matrix of the pair energies filled by ``d3`` in ``pairs``.
+
+    Parameters
+    ----------
+    pairs: Dict[Tuple[int, int], Tuple[float, float]]
+      R^-6 and R^-8 energies of the pairs ``(i, j)``, ``i < j``.
+    natoms: int
+
+    Returns
+    -------
+    Array laid out as in ``pair_energy_matrix``, zero for the pairs missing
+    from ``pairs``.
+    """
+
+    energies = np.zeros((natoms * (natoms - 1) // 2, 3))
+    if pairs:
+        i, j = np.array(list(pairs), dtype=np.int64).T
+        # position of the pairs in the packed upper triangle
+        rows = i * (2 * natoms - i - 1) // 2 + j - i - 1
+        energies[rows, :2] = list(pairs.values())
+        energies[:, 2] = energies[:, 0] + energies[:, 1]
+
+    return energies
+
+
+def fragment_energies(config, charges, coordinates, labels, block_size=1024):
+    """Matrix of the D3 pair interaction energies between fragments.
+
+    All pairs are visited once and their energies accumulated into the
+    fragment blocks they belong to, so the cost does not depend on the number
+    of fragments. The 3-body term is not pairwise and is left out.
+
+    Parameters
+    ----------
+    config: D3Configuration
+    charges: List[int]
+      Atomic numbers.
+    coordinates: List[float]
+      Flat list of Cartesian coordinates, in bohr.
+    labels: List[int]
+      Fragment of each atom, numbered from 0, e.g. from ``fragment_labels``.
+
+    Returns
+    -------
+    Symmetric array of shape ``(nfragments, nfragments)``, in hartree. The
+    off-diagonal entries are the interaction energies between two fragments
+    and the diagonal entries the energies within each fragment, so that the
+    upper triangle sums to the total 2-body D3 energy.
+    """
+
+    labels = np.asarray(labels, dtype=int)
+    nfragments = labels.max() + 1 if len(labels) else 0
+
+    energies = np.zeros(nfragments * nfragments)
+    for i, j, e6, e8 in iter_pair_energies(config, charges, coordinates, block_size):
+        blocks = np.minimum(labels[i], labels[j]) * nfragments + np.maximum(
+            labels[i], labels[j]
+        )
+        energies += np.bincount(blocks, weights=e6 + e8, minlength=len(energies))
+
+    energies = energies.reshape(nfragments, nfragments)
+
+    return energies + np.triu(energies, k=1).T
+
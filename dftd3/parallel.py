@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+#
+
+"""Long-lived pool of warm worker processes with guided scheduling."""
+
+import atexit
+import math
+import multiprocessing as mp
+import os
+import time
+from collections import defaultdict
+from functools import partial
+from itertools import islice
+
+_POOL = None
+"""Tuple[int, multiprocessing.pool.Pool]: the shared pool and its size."""
+
+
+def _warm_worker():
+    # importing the driver pulls in JAX and the parameter tables once per
+    # worker; a throwaway derivative pays for JAX's first-call setup
+    from jax import grad
+
+    from . import dftd3  # noqa: F401
+
+    grad(lambda x: x * x)(1.0)
+
+
+def _run_chunk(worker, chunk):
+    start = time.perf_counter()
+    values = [worker(task) for task in chunk]
+    return values, os.getpid(), time.perf_counter() - start
+
+
+def get_pool(nprocs):
+    """Return the shared pool of ``nprocs`` warm workers, starting it if needed.
+
+    The pool is kept for the lifetime of the process, so that consecutive
+    calls, e.g. one per input file, do not pay for starting the workers and
+    importing JAX again. Asking for a different size replaces it.
+    """
+    global _POOL
+
+    if _POOL is None or _POOL[0] != nprocs:
+        close_pool()
+        _POOL = (nprocs, mp.Pool(processes=nprocs, initializer=_warm_worker))
+
+    return _POOL[1]
+
+
+def close_pool():
+    """Shut down the shared pool, if any."""
+    global _POOL
+
+    if _POOL is not None:
+        _POOL[1].close()
+        _POOL[1].join()
+        _POOL = None
+
+
+atexit.register(close_pool)
+
+
+def guided_chunks(tasks, nprocs, min_size=1):
+    """Split a list of tasks into chunks of decreasing size.
+
+    Each chunk takes half of an even share of the remaining tasks, so that
+    early chunks amortize the dispatch overhead and late, small chunks
+    even out the load when tasks differ in cost.
+    """
+    start = 0
+    while start < len(tasks):
+        size = max(min_size, math.ceil((len(tasks) - start) / (2 * nprocs)))
+        yield tasks[start : start + size]
+        start += size
+
+
+def evaluate(
+    worker, tasks, nprocs, block_size=4096, ordered=True, utilization=None
+):
+    """Yield ``worker(task)`` for each task, in order.
+
+    Tasks are handed to the shared pool one block at a time, so that neither
+    the task list nor the results are ever held in memory all at once. Within
+    a block, the tasks are dispatched in guided chunks. With
+    ``ordered=False``, the results of each chunk are yielded as soon as it is
+    done instead, whatever the order.
+
+    If a dictionary is passed as ``utilization``, it is filled when done, if
+    more than one process was used, with
+    the number of tasks and the busy time in seconds of each worker, by
+    process id, and the wall time under ``"wall"``; see
+    ``utilization_report``.
+    """
+    if nprocs <= 1:
+        yield from map(worker, tasks)
+        return
+
+    pool = get_pool(nprocs)
+    start = time.perf_counter()
+    busy = defaultdict(float)
+    ntasks = defaultdict(int)
+
+    while True:
+        block = list(islice(tasks, block_size))
+        if not block:
+            break
+        chunks = guided_chunks(block, nprocs)
+        imap = pool.imap if ordered else pool.imap_unordered
+        for values, pid, elapsed in imap(partial(_run_chunk, worker), chunks):
+            busy[pid] += elapsed
+            ntasks[pid] += len(values)
+            yield from values
+
+    if utilization is not None:
+        for pid in busy:
+            utilization[pid] = (ntasks[pid], busy[pid])
+        utilization["wall"] = time.perf_counter() - start
+
+
+def utilization_report(utilization):
+    """Text report of the worker utilization filled in by ``evaluate``."""
+
+    wall = utilization["wall"]
+    report = "    - Worker utilization:\n"
+    for pid in sorted(pid for pid in utilization if pid != "wall"):
+        ntasks, busy = utilization[pid]
+        usage = 100 * busy / wall
+        report += f"      worker {pid}: {ntasks} tasks, "
+        report += f"{busy:.2f} s busy ({usage:.0f}%)\n"
+
+    return report
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+#
+
+"""D3 energies of many subsets of the atoms of one structure."""
+
+from itertools import combinations
+
+import numpy as np
+
+from .constants import CN_CUTOFF, PAIR_CUTOFF
+from .pairs import (
+    bonded_pairs,
+    c6_coefficients,
+    counting_function,
+    damped_terms,
+    intermolecular_labels,
+    neighbor_pairs,
+    scale_factors,
+)
+
+
+def fragment_masks(labels, order):
+    """Atom masks of all combinations of ``order`` fragments.
+
+    Parameters
+    ----------
+    labels: List[int]
+      Fragment of each atom, numbered from 0, e.g. from ``fragment_labels``.
+    order: int
+      Number of fragments per combination: 1 for monomers, 2 for dimers...
+
+    Returns
+    -------
+    Tuple of the list of fragment combinations and the boolean masks of their
+    atoms, of shape ``(ncombinations, natoms)``.
+    """
+
+    labels = np.asarray(labels, dtype=int)
+    nfragments = labels.max() + 1 if len(labels) else 0
+    combos = list(combinations(range(nfragments), order))
+    masks = np.zeros((len(combos), len(labels)), dtype=bool)
+    for row, combo in enumerate(combos):
+        masks[row] = np.isin(labels, combo)
+
+    return combos, masks
+
+
+class SubsystemD3:
+    """D3 energies of subsets of the atoms of one structure.
+
+    The coordination numbers of a subset, and so its C6 coefficients, depend
+    on the atoms it contains, but the damped distance terms of its pairs do
+    not. These terms and the contributions of the pairs of atoms to the
+    coordination numbers are computed once, for the pairs closer than
+    ``cutoff`` and ``CN_CUTOFF`` respectively, and stored as arrays over
+    these pairs. The energy of a subset is then the sum over its pairs of the
+    stored terms times C6 coefficients interpolated at the coordination
+    numbers of the subset.
+
+    As in region calculations, pairs beyond the cutoffs are left out, so that
+    for structures larger than the cutoffs the energies differ slightly from
+    those of ``d3``.
+
+    The 3-body term is not supported. With ``config.bonded_scaling`` and
+    ``config.intermolecular``, bonds and fragments are those of the whole
+    structure.
+
+    Parameters
+    ----------
+    config: D3Configuration
+    charges: List[int]
+      Atomic numbers.
+    coordinates: List[float]
+      Flat list of Cartesian coordinates, in bohr.
+    cutoff: float
+      Distance in bohr beyond which pairs are left out.
+    block_size: int
+      At most ``block_size**2`` pairs are evaluated at once, to bound memory.
+    """
+
+    def __init__(
+        self, config, charges, coordinates, cutoff=PAIR_CUTOFF, block_size=1024
+    ):
+        if config.threebody:
+            raise RuntimeError("The 3-body term is not supported by SubsystemD3.")
+
+        self.config = config
+        self.cutoff = cutoff
+        self.block_size = block_size
+        self.charges = np.asarray(charges, dtype=int) - 1
+        xyz = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+        atoms = np.arange(len(self.charges))
+
+        scaled = None
+        if config.bonded_scaling:
+            scaled = bonded_pairs(config, charges, coordinates)
+        labels = intermolecular_labels(config, charges, coordinates)
+
+        # counting function of the pairs (a, b) within CN_CUTOFF, in both
+        # orders, whose sums over the atoms b of a subset are its
+        # coordination numbers
+        self._ca, self._cb = neighbor_pairs(xyz, atoms, CN_CUTOFF)
+        self._counts = counting_function(self.charges, xyz, self._ca, self._cb)
+
+        # energy per unit C6 of the pairs i < j within the cutoff
+        i, j = neighbor_pairs(xyz, atoms, cutoff)
+        self._i, self._j = i[i < j], j[i < j]
+        self._terms = np.zeros(len(self._i))
+        for start in range(0, len(self._i), block_size**2):
+            block = slice(start, start + block_size**2)
+            i, j = self._i[block], self._j[block]
+            g6, g8 = damped_terms(config, self.charges, xyz, i, j)
+            terms = g6 + g8
+            if scaled is not None:
+                terms = terms * scale_factors(scaled, len(atoms), i, j)
+            if labels is not None:
+                terms = np.where(labels[i] != labels[j], terms, 0.0)
+            self._terms[block] = terms
+
+    def _chunks(self, masks, npairs):
+        # subsets of masks by chunks, so that a chunk selects at most about
+        # block_size**2 of the npairs stored pairs
+        step = max(1, self.block_size**2 // max(npairs, 1))
+        for start in range(0, len(masks), step):
+            yield np.arange(start, min(start + step, len(masks)))
+
+    def energies(self, masks):
+        """D3 energies of several subsets of the atoms.
+
+        The coordination numbers and the C6 coefficients of the pairs of
+        several subsets are computed at once, in large batches.
+
+        Parameters
+        ----------
+        masks: np.ndarray
+          Boolean masks of the atoms of each subset, of shape
+          ``(nsubsets, natoms)``.
+
+        Returns
+        -------
+        Energy of each subset, in hartree.
+        """
+
+        masks = np.atleast_2d(np.asarray(masks, dtype=bool))
+        natoms = len(self.charges)
+        nsubsets = len(masks)
+
+        # the atoms of every subset side by side, to index cn
+        cn = np.zeros(nsubsets * natoms)
+        for queries in self._chunks(masks, len(self._ca)):
+            query, pair = np.nonzero(masks[queries][:, self._cb])
+            cn += np.bincount(
+                queries[query] * natoms + self._ca[pair],
+                weights=self._counts[pair],
+                minlength=len(cn),
+            )
+        charges = np.tile(self.charges, nsubsets)
+
+        energies = np.zeros(nsubsets)
+        for queries in self._chunks(masks, len(self._i)):
+            chunk = masks[queries]
+            query, pair = np.nonzero(chunk[:, self._i] & chunk[:, self._j])
+            query = queries[query]
+            i, j = self._i[pair], self._j[pair]
+            c6 = c6_coefficients(charges, cn, query * natoms + i, query * natoms + j)
+            energies += np.bincount(
+                query, weights=c6 * self._terms[pair], minlength=nsubsets
+            )
+
+        return energies
+
+    def energy(self, mask):
+        """D3 energy of the subset of atoms selected by the boolean ``mask``."""
+
+        return float(self.energies([mask])[0])
@@ -28,12 +28,17 @@
 #
 
 
+import hashlib
+from collections import defaultdict, deque
 from dataclasses import InitVar, dataclass, field
+from itertools import product
 from typing import List
 
+import jax
 import jax.numpy as jnp
+import numpy as np
 
-from .constants import AU_TO_ANG
+from .constants import AU_TO_ANG, CN_CUTOFF, PAIR_CUTOFF
 from .parameters import BJ_PARMS, RCOV, ZERO_PARMS
 
 
@@ -52,32 +57,227 @@ def der_order(order: int) -> str:
         return f"{order}-{_suffix[order - 1]}"
 
 
-def getMollist(bondmatrix, startatom):
-    """From connectivity, establish if there is more than one molecule."""
+def fragment_labels(bondindex):
+    """Label the molecular fragments, i.e. the connected components of the bond graph.
 
-    # The list of atoms in a molecule
-    atomlist = []
-    atomlist.append(startatom)
-    count = 0
+    Each fragment is found by a breadth-first search, so that the cost is
+    linear in the number of atoms and bonds.
 
-    while count < 100:
-        for atom in atomlist:
-            for i in range(0, len(bondmatrix[atom])):
-                if bondmatrix[atom][i] == 1:
-                    alreadyfound = 0
-                    for at in atomlist:
-                        if i == at:
-                            alreadyfound = 1
-                    if alreadyfound == 0:
-                        atomlist.append(i)
-        count = count + 1
+    Parameters
+    ----------
+    bondindex: List[List[int]]
+      Atoms bonded to each atom.
+
+    Returns
+    -------
+    List[int]
+      Fragment of each atom, numbered from 0 in order of their lowest atom.
+    """
+    labels = [-1] * len(bondindex)
+    fragment = 0
+    for start in range(len(bondindex)):
+        if labels[start] != -1:
+            continue
+        labels[start] = fragment
+        queue = deque([start])
+        while queue:
+            atom = queue.popleft()
+            for neighbour in bondindex[atom]:
+                if labels[neighbour] == -1:
+                    labels[neighbour] = fragment
+                    queue.append(neighbour)
+        fragment += 1
+
+    return labels
+
+
+def topological_distances(bondindex, max_depth=3):
+    """Number of bonds between atoms, up to ``max_depth``.
+
+    Parameters
+    ----------
+    bondindex: List[List[int]]
+      Atoms bonded to each atom.
+    max_depth: int
+      Longest path searched, in bonds.
+
+    Returns
+    -------
+    List[Dict[int, int]]
+      For each atom, the atoms at most ``max_depth`` bonds away, mapped to the
+      number of bonds on the shortest path between them.
+    """
+    distances = []
+    for start in range(len(bondindex)):
+        found = {start: 0}
+        shell = [start]
+        for depth in range(1, max_depth + 1):
+            next_shell = []
+            for atom in shell:
+                for neighbour in bondindex[atom]:
+                    if neighbour not in found:
+                        found[neighbour] = depth
+                        next_shell.append(neighbour)
+            shell = next_shell
+        del found[start]
+        distances.append(found)
+
+    return distances
+
+
+def infer_bonds(charges, coordinates, scale=4 / 3):
+    """Infer the bonds of a structure from its geometry.
+
+    Two atoms are bonded when closer than ``scale`` times the sum of their
+    covalent radii; the default is the fraction used for the coordination
+    numbers in ``ncoord``. Atoms are binned in cubic cells as large as the
+    longest possible bond, so that only atoms in neighbouring cells are
+    compared and the cost is linear in the number of atoms.
+
+    Parameters
+    ----------
+    charges: List[int]
+      Atomic numbers.
+    coordinates: List[float]
+      Flat list of Cartesian coordinates, in bohr. These may be JAX tracers
+      from differentiation, as long as they hold concrete values.
+    scale: float
+      Fraction of the summed covalent radii below which atoms are bonded.
+
+    Returns
+    -------
+    List[List[int]]
+      Atoms bonded to each atom, in the format of ``getinData.BONDINDEX``.
+    """
+    if isinstance(coordinates, np.ndarray):
+        xyz = coordinates.astype(float)
+    else:
+        xyz = np.array([jax.core.concrete_or_error(float, x) for x in coordinates])
+    xyz = xyz.reshape(-1, 3) * AU_TO_ANG
+    radii = np.array(RCOV)[np.asarray(charges, dtype=int) - 1]
+    bonds = [[] for _ in range(len(radii))]
+    if len(radii) == 0:
+        return bonds
+
+    cutoff = 2 * scale * radii.max()
+    cells = defaultdict(list)
+    indices = np.floor((xyz - xyz.min(axis=0)) / cutoff).astype(int)
+    for atom, cell in enumerate(indices):
+        cells[tuple(cell)].append(atom)
+    cells = {cell: np.array(atoms) for cell, atoms in cells.items()}
+
+    # each cell is compared with itself and half of its 26 neighbours
+    offsets = [shift for shift in product((-1, 0, 1), repeat=3) if shift > (0, 0, 0)]
+    for cell, first in cells.items():
+        for offset in [(0, 0, 0)] + offsets:
+            second = cells.get(tuple(c + o for c, o in zip(cell, offset)))
+            if second is None:
+                continue
+            distances = np.linalg.norm(xyz[first, None] - xyz[None, second], axis=-1)
+            bonded = distances < scale * (radii[first, None] + radii[None, second])
+            if offset == (0, 0, 0):
+                bonded = np.triu(bonded, k=1)
+            for j, k in zip(*np.nonzero(bonded)):
+                bonds[first[j]].append(int(second[k]))
+                bonds[second[k]].append(int(first[j]))
+
+    return [sorted(bonded) for bonded in bonds]
+
+
+def neighbor_lists(coordinates, atoms, cutoff):
+    """Atoms closer than ``cutoff`` to each of ``atoms``.
+
+    Atoms are binned in cubic cells of side ``cutoff``, as in
+    ``infer_bonds``, so that only the 27 cells around each of ``atoms`` are
+    searched.
+
+    Parameters
+    ----------
+    coordinates: List[float]
+      Flat list or array of Cartesian coordinates, in bohr. These may be JAX
+      tracers from differentiation, as long as they hold concrete values.
+    atoms: List[int]
+      Atoms whose neighbours are listed.
+    cutoff: float
+      Distance in bohr.
+
+    Returns
+    -------
+    List[np.ndarray]
+      Sorted neighbours of each of ``atoms``, without the atom itself.
+    """
+    if isinstance(coordinates, np.ndarray):
+        xyz = coordinates.astype(float)
+    else:
+        xyz = np.array([jax.core.concrete_or_error(float, x) for x in coordinates])
+    xyz = xyz.reshape(-1, 3)
+    if len(xyz) == 0:
+        return [np.zeros(0, dtype=int) for _ in atoms]
+
+    cells = defaultdict(list)
+    indices = np.floor((xyz - xyz.min(axis=0)) / cutoff).astype(int)
+    for atom, cell in enumerate(indices):
+        cells[tuple(cell)].append(atom)
+    cells = {cell: np.array(members) for cell, members in cells.items()}
+
+    neighbors = []
+    for atom in atoms:
+        candidates = [
+            cells[cell]
+            for cell in (
+                tuple(c + o for c, o in zip(indices[atom], offset))
+                for offset in product((-1, 0, 1), repeat=3)
+            )
+            if cell in cells
+        ]
+        candidates = np.concatenate(candidates)
+        distances = np.linalg.norm(xyz[candidates] - xyz[atom], axis=-1)
+        close = candidates[(distances < cutoff) & (candidates != atom)]
+        neighbors.append(np.sort(close))
+
+    return neighbors
+
+
+def region_atoms(region, coordinates, cutoff=PAIR_CUTOFF):
+    """Atoms of a region and of its environment closer than ``cutoff`` to it.
+
+    Parameters
+    ----------
+    region: List[int]
+      Atoms of the region.
+    coordinates: List[float]
+      Flat list of Cartesian coordinates, in bohr.
+    cutoff: float
+      Distance in bohr from the closest atom of the region beyond which
+      environment atoms are left out.
+
+    Returns
+    -------
+    np.ndarray
+      Sorted atoms of the region and of its environment.
+    """
+    neighbors = neighbor_lists(coordinates, region, cutoff)
+
+    return np.unique(np.concatenate([np.asarray(region, dtype=int)] + neighbors))
 
-    return atomlist
 
+def getMollist(bondindex, startatom):
+    """From connectivity, list the atoms in the same molecule as ``startatom``.
 
-def ncoord(charges, coordinates, k1=16, k2=4 / 3):
+    ``bondindex`` lists the atoms bonded to each atom.
+    """
+    labels = fragment_labels(bondindex)
+
+    return [atom for atom, label in enumerate(labels) if label == labels[startatom]]
+
+
+def ncoord(charges, coordinates, k1=16, k2=4 / 3, atoms=None):
     """Calculation of atomic coordination numbers.
 
+    If ``atoms`` is given, only the coordination numbers of these atoms are
+    computed, as a dictionary keyed by atom, counting the neighbours closer
+    than ``CN_CUTOFF``.
+
     Notes
     -----
     The constants ``k1`` and ``k2`` are used to determine fractional connectivities between 2 atoms:
@@ -92,12 +292,17 @@ def ncoord(charges, coordinates, k1=16, k2=4 / 3):
 
     check_inputs(charges=charges, coordinates=coordinates)
 
+    if atoms is None:
+        partners = [range(natom)] * natom
+    else:
+        partners = neighbor_lists(coordinates, atoms, CN_CUTOFF)
+
     coordinates = [coordinate * AU_TO_ANG for coordinate in coordinates]
     cn = []
 
-    for i in range(natom):
+    for i, neighbors in zip(range(natom) if atoms is None else atoms, partners):
         xn = 0.0
-        for iat in range(natom):
+        for iat in neighbors:
             if iat != i:
                 r = jnp.sqrt(
                     (coordinates[3 * i] - coordinates[3 * iat]) ** 2
@@ -114,6 +319,9 @@ def ncoord(charges, coordinates, k1=16, k2=4 / 3):
                 xn = xn + damp
         cn.append(xn)
 
+    if atoms is not None:
+        return dict(zip(atoms, cn))
+
     return cn
 
 
@@ -169,6 +377,56 @@ def getc6(c6ab, mxc, atomtype, cn, a, b, k3=-4.0):
     return c6
 
 
+def apply_sum_rules(dervs):
+    """Fill in the entries of the last atom of a derivative tensor from the translational sum rules.
+
+    Notes
+    -----
+    The D3 energy is invariant under rigid translations, so summing a
+    derivative tensor of shape ``(natoms, 3) * order`` over the atoms of any
+    one slot gives zero. Only the entries where all atom indices are below
+    ``natoms - 1`` need to be set on input; the rest are overwritten in place,
+    one slot at a time.
+    """
+
+    order = dervs.ndim // 2
+    last = dervs.shape[0] - 1
+
+    for slot in range(order):
+        target = []
+        source = []
+        for other in range(order):
+            if other < slot:
+                atoms = slice(None)
+            elif other == slot:
+                atoms = last
+            else:
+                atoms = slice(0, last)
+            target += [atoms, slice(None)]
+            source += [slice(0, last) if other == slot else atoms, slice(None)]
+        dervs[tuple(target)] = -dervs[tuple(source)].sum(axis=2 * slot)
+
+    return dervs
+
+
+def sum_rule_residual(dervs):
+    """Largest violation of the translational sum rules by a derivative tensor of shape ``(natoms, 3) * order``."""
+
+    order = dervs.ndim // 2
+
+    return max(float(abs(dervs.sum(axis=2 * slot)).max()) for slot in range(order))
+
+
+def geometry_hash(charges, coordinates):
+    """SHA-256 digest identifying a set of atomic numbers and coordinates."""
+
+    digest = hashlib.sha256()
+    digest.update(repr([int(charge) for charge in charges]).encode())
+    digest.update(repr([float(coordinate) for coordinate in coordinates]).encode())
+
+    return digest.hexdigest()
+
+
 def check_inputs(*, charges, coordinates):
 
     natom = len(charges)
@@ -190,9 +448,16 @@ class D3Configuration:
     a1: float = field(init=False)
     a2: float = field(init=False)
     threebody: bool = False
+    # atoms bonded to each atom
     bond_index: List[List[int]] = None
     intermolecular: bool = False
-    pairwise: bool = False
+    # exclude 1-2 and 1-3 pairs and scale down 1-4 pairs
+    bonded_scaling: bool = False
+    # only pairs with at least one atom of the region are computed
+    region: List[int] = None
+    # environment atoms farther than this from the region are left out, in bohr,
+    # PAIR_CUTOFF if None
+    region_cutoff: float = None
 
     # initialization-only variables
     _s6: InitVar[float] = 0.0
@@ -240,5 +505,7 @@ class D3Configuration:
             cfg += "    - Including the Axilrod-Teller-Muto 3-body dispersion term\n"
         if self.intermolecular:
             cfg += "    - Only computing intermolecular dispersion interactions! This is not the total D3-correction\n"
+        if self.region is not None:
+            cfg += f"    - Only computing pairs with the {len(self.region)} atoms of the region! This is not the total D3-correction\n"
 
         print(cfg)
@@ -31,14 +31,36 @@
 import json
 from pathlib import Path
 
+import jax
+import jax.numpy as jnp
 import numpy as np
 import pytest
 from qcelemental import periodictable as PT
 
-from dftd3.ccParse import get_simple_data, getinData, getoutData
-from dftd3.dftd3 import D3_derivatives, D3Configuration, d3, D3_element_wise
+from dftd3.ccParse import get_simple_data, getinData, getoutData, getxyzData
+from dftd3.cli import cli
+from dftd3.dftd3 import (
+    D3_derivatives,
+    D3_projected_derivatives,
+    D3Configuration,
+    d3,
+    D3_element_wise,
+    _derivative_component,
+    _process_file,
+    completion_file,
+    main,
+)
 from dftd3.jax_diff import _derv_sequence
-from dftd3.utils import der_order
+from dftd3.pairs import pair_energy_matrix
+from dftd3.parallel import close_pool, get_pool, guided_chunks
+from dftd3.utils import (
+    der_order,
+    fragment_labels,
+    getMollist,
+    infer_bonds,
+    sum_rule_residual,
+    topological_distances,
+)
 
 HERE = Path(__file__).parents[1]
 
@@ -62,6 +84,11 @@ def _from_txt(inp):
     return data.CARTESIANS, data.CHARGES, data.FUNCTIONAL
 
 
+def _from_xyz(inp):
+    data = getxyzData(inp)
+    return data.CARTESIANS, data.CHARGES, "B3LYP"
+
+
 def _from_com(inp):
     data = getinData(inp)
     return data.CARTESIANS, data.CHARGES, data.FUNCTIONAL
@@ -79,8 +106,9 @@ def _from_log(inp):
         (_from_com(HERE / "examples/formic_acid_dimer.com")),
         (_from_log(HERE / "examples/formic_acid_dimer.log")),
         (_from_json(HERE / "examples/formic_acid_dimer.json")),
+        (_from_xyz(HERE / "examples/formic_acid_dimer.xyz")),
     ],
-    ids=["from_txt", "from_com", "from_log", "from_json"],
+    ids=["from_txt", "from_com", "from_log", "from_json", "from_xyz"],
 )
 @pytest.mark.parametrize(
     "damping,ref",
@@ -172,6 +200,464 @@ def test_derivatives(damping, ref, order):
         ), f"Element {i} of {der_order(order)} order derivative differs from reference (Delta = {x - ref[i]})"
 
 
+def test_projected_derivatives():
+    data = getoutData(HERE / "examples/CH3F2TS.log")
+    assert len(data.FREQUENCIES) == 12
+    assert data.FREQUENCIES[0] == pytest.approx(-526.3264)
+    assert np.array(data.NORMALMODES).shape == (12, 18)
+
+    config = D3Configuration(functional=data.FUNCTIONAL, damp="bj")
+    modes = np.array(data.NORMALMODES[:4])
+
+    gradient = D3_derivatives(1, config, data.CHARGES, *data.CARTESIANS)
+    projected = D3_projected_derivatives(
+        1, modes, config, data.CHARGES, *data.CARTESIANS
+    )
+
+    assert projected.shape == (4,)
+    assert projected == pytest.approx(modes @ gradient.reshape(-1), abs=1.0e-10)
+
+    # second order: nested JVPs, with the off-diagonal entries filled in by
+    # symmetry
+    modes = modes[:3]
+    hessian = jax.hessian(lambda x: d3(config, data.CHARGES, *x))(
+        jnp.array(data.CARTESIANS)
+    )
+    projected = D3_projected_derivatives(
+        2, modes, config, data.CHARGES, *data.CARTESIANS
+    )
+
+    assert projected.shape == (3, 3)
+    assert projected == pytest.approx(
+        modes @ np.asarray(hessian) @ modes.T, rel=1.0e-8, abs=1.0e-12
+    )
+
+
+def test_sum_rules():
+    coordinates, charges, functional = _from_com(HERE / "examples/CH3F.com")
+    config = D3Configuration(functional=functional, damp="bj")
+
+    full = D3_derivatives(1, config, charges, *coordinates)
+    reconstructed = D3_derivatives(1, config, charges, *coordinates, sum_rules=True)
+
+    assert sum_rule_residual(full) < 1.0e-10
+    assert reconstructed == pytest.approx(full, abs=1.0e-10)
+
+
+def test_sum_rules_hessian():
+    # water, in bohr
+    charges = [8, 1, 1]
+    coordinates = [0.0, 0.0, 0.2217, 0.0, 1.4309, -0.8867, 0.0, -1.4309, -0.8867]
+    config = D3Configuration(functional="B3LYP", damp="bj")
+
+    # the full Hessian in one pass, as a reference
+    full = jax.hessian(lambda x: d3(config, charges, *x))(jnp.array(coordinates))
+    full = np.asarray(full).reshape(3, 3, 3, 3)
+    check = {}
+    reconstructed = D3_derivatives(
+        2, config, charges, *coordinates, sum_rules=True, sum_rule_check=check
+    )
+
+    assert reconstructed.shape == (3, 3, 3, 3)
+    assert reconstructed == pytest.approx(full, abs=1.0e-14)
+    assert check["residual"] < 1.0e-14
+
+
+def test_streamed_derivatives(tmp_path, monkeypatch):
+    coordinates, charges, functional = _from_com(HERE / "examples/CH3F.com")
+    config = D3Configuration(functional=functional, damp="bj")
+    outfile = tmp_path / "gradient.npy"
+
+    full = D3_derivatives(1, config, charges, *coordinates)
+    streamed = D3_derivatives(1, config, charges, *coordinates, outfile=outfile)
+
+    assert streamed == pytest.approx(full, abs=1.0e-12)
+    assert np.load(outfile) == pytest.approx(full, abs=1.0e-12)
+    assert np.load(completion_file(outfile)).all()
+
+    # a run killed after 4 components leaves them, and only them, marked
+    calls = []
+
+    def interrupted(component, **kwargs):
+        if len(calls) == 4:
+            raise KeyboardInterrupt
+        calls.append(component)
+        return _derivative_component(component, **kwargs)
+
+    monkeypatch.setattr("dftd3.dftd3._derivative_component", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        D3_derivatives(1, config, charges, *coordinates, outfile=outfile)
+
+    computed = np.load(completion_file(outfile))
+    assert computed.tolist() == [True] * 4 + [False] * 11
+    assert np.load(outfile).reshape(-1)[computed] == pytest.approx(
+        full.reshape(-1)[:4], abs=1.0e-12
+    )
+
+
+def test_checkpoint_resume(tmp_path):
+    coordinates, charges, functional = _from_com(HERE / "examples/CH3F.com")
+    config = D3Configuration(functional=functional, damp="zero")
+
+    first = D3_derivatives(1, config, charges, *coordinates, checkpoint=tmp_path)
+    segments = list(tmp_path.glob("*/part-*.npz"))
+    assert len(segments) == 1
+
+    # everything is already checkpointed, so nothing is recomputed
+    resumed = D3_derivatives(
+        1, config, charges, *coordinates, checkpoint=tmp_path, resume=True
+    )
+    assert list(tmp_path.glob("*/part-*.npz")) == segments
+    assert resumed == pytest.approx(first, abs=1.0e-12)
+
+
+def test_checkpoint_interrupted(tmp_path, monkeypatch):
+    coordinates, charges, functional = _from_com(HERE / "examples/CH3F.com")
+    config = D3Configuration(functional=functional, damp="zero")
+    clean = D3_derivatives(1, config, charges, *coordinates)
+
+    calls = []
+
+    def counted(component, **kwargs):
+        if limit is not None and len(calls) == limit:
+            raise KeyboardInterrupt
+        calls.append(component)
+        return _derivative_component(component, **kwargs)
+
+    monkeypatch.setattr("dftd3.dftd3._derivative_component", counted)
+
+    # killed after 6 of the 15 components: those are saved on the way out
+    limit = 6
+    with pytest.raises(KeyboardInterrupt):
+        D3_derivatives(1, config, charges, *coordinates, checkpoint=tmp_path)
+    assert len(list(tmp_path.glob("*/part-*.npz"))) == 1
+
+    calls.clear()
+    limit = None
+    resumed = D3_derivatives(
+        1, config, charges, *coordinates, checkpoint=tmp_path, resume=True
+    )
+
+    assert calls == [(component,) for component in range(6, 15)]
+    assert len(list(tmp_path.glob("*/part-*.npz"))) == 2
+    assert resumed == pytest.approx(clean, abs=1.0e-12)
+
+
+@pytest.mark.parametrize("ntasks,nprocs", [(100, 4), (3, 8), (0, 2)])
+def test_guided_chunks(ntasks, nprocs):
+    tasks = list(range(ntasks))
+    chunks = list(guided_chunks(tasks, nprocs))
+
+    assert sum(chunks, []) == tasks
+    assert all(len(a) >= len(b) for a, b in zip(chunks, chunks[1:]))
+
+
+def test_parallel_derivatives():
+    # water, in bohr
+    charges = [8, 1, 1]
+    coordinates = [0.0, 0.0, 0.2217, 0.0, 1.4309, -0.8867, 0.0, -1.4309, -0.8867]
+    serial = D3_derivatives(
+        1, D3Configuration(functional="B3LYP", damp="bj"), charges, *coordinates
+    )
+
+    config = D3Configuration(functional="B3LYP", damp="bj", nprocs=2)
+    utilization = {}
+    gradient = D3_derivatives(
+        1, config, charges, *coordinates, utilization=utilization
+    )
+    pool = get_pool(2)
+    # the warm pool is reused by the next call
+    again = D3_derivatives(1, config, charges, *coordinates)
+    assert get_pool(2) is pool
+    close_pool()
+
+    assert gradient == pytest.approx(serial, abs=1.0e-14)
+    assert again == pytest.approx(serial, abs=1.0e-14)
+    assert sum(utilization[pid][0] for pid in utilization if pid != "wall") == 9
+    assert utilization["wall"] > 0.0
+
+
+def test_process_file(monkeypatch):
+    monkeypatch.setattr("sys.argv", ["dftd3", "--damp", "bj"])
+    args = cli()
+    reference = _process_file(HERE / "examples/formic_acid_dimer.txt", args)
+    _, total_vdw, record = _process_file(
+        HERE / "examples/formic_acid_dimer.json", args
+    )
+
+    assert total_vdw == pytest.approx(reference[1])
+    assert record["output"]["D3 energy (au)"] == total_vdw
+
+
+def test_binary_output(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        "sys.argv", ["dftd3", "--damp", "bj", "--order", "1", "--binary"]
+    )
+    args = cli()
+    _, _, record = _process_file(HERE / "examples/CH3F.com", args)
+
+    coordinates, charges, functional = _from_com(HERE / "examples/CH3F.com")
+    config = D3Configuration(functional=functional, damp="bj")
+    gradient = np.load("CH3F.npy", mmap_mode="r")
+
+    assert record["output"]["1-st order geometric derivative"] == {
+        "file": "CH3F.npy",
+        "shape": [5, 3],
+        "dtype": "float64",
+    }
+    assert len(record["input"]["geometry_hash"]) == 64
+    assert gradient == pytest.approx(
+        D3_derivatives(1, config, charges, *coordinates), abs=1.0e-10
+    )
+
+
+def test_pairwise_output(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("sys.argv", ["dftd3", "--damp", "bj", "--pairwise"])
+    args = cli()
+    f = HERE / "examples/formic_acid_dimer.com"
+    _, total_vdw, record = _process_file(f, args)
+
+    data = getinData(f)
+    config = D3Configuration(functional=data.FUNCTIONAL, damp="bj")
+    pairs = np.array(record["output"]["Pair energies (au)"])
+    assert pairs == pytest.approx(
+        pair_energy_matrix(config, data.CHARGES, data.CARTESIANS), rel=1.0e-12
+    )
+    assert pairs[:, 2].sum() == pytest.approx(total_vdw, rel=1.0e-12)
+
+    # beyond the limit, the matrix only goes to .npy
+    monkeypatch.setattr("dftd3.dftd3.MAX_RECORD_PAIRS", 44)
+    _, _, record = _process_file(f, args)
+    assert record["output"]["Pair energies (au)"] == {
+        "file": "formic_acid_dimer_pairs.npy",
+        "shape": [45, 3],
+        "dtype": "float64",
+    }
+    assert np.load("formic_acid_dimer_pairs.npy") == pytest.approx(pairs)
+
+    monkeypatch.setattr(
+        "sys.argv", ["dftd3", "--pairwise", "--region", "1-5", str(f)]
+    )
+    with pytest.raises(RuntimeError):
+        main()
+
+
+def test_jsonl(monkeypatch, tmp_path):
+    output = tmp_path / "results.jsonl"
+    inputs = [
+        str(HERE / "examples/formic_acid_dimer.txt"),
+        str(HERE / "examples/formic_acid_dimer.com"),
+    ]
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        "sys.argv", ["dftd3", "--damp", "bj", "--jsonl", str(output), *inputs]
+    )
+    main()
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+
+    assert [record["file"] for record in records] == inputs
+    assert records[0]["output"]["D3 energy (au)"] == pytest.approx(
+        records[1]["output"]["D3 energy (au)"]
+    )
+    # no per-file JSON in this mode
+    assert list(tmp_path.iterdir()) == [output]
+
+
+@pytest.mark.parametrize("unordered", [False, True])
+def test_jobs(monkeypatch, tmp_path, unordered):
+    output = tmp_path / "results.jsonl"
+    inputs = [
+        str(HERE / "examples/formic_acid_dimer.txt"),
+        str(HERE / "examples/CH3F.com"),
+        str(HERE / "examples/formic_acid_dimer.com"),
+    ]
+    options = ["--unordered"] if unordered else []
+    monkeypatch.setattr(
+        "sys.argv",
+        ["dftd3", "--damp", "bj", "--jobs", "2", *options, "--jsonl", str(output)]
+        + inputs,
+    )
+    main()
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    files = [record["file"] for record in records]
+
+    # in input order, or as the files finish
+    if unordered:
+        assert sorted(files) == sorted(inputs)
+    else:
+        assert files == inputs
+    energies = {record["file"]: record["output"]["D3 energy (au)"] for record in records}
+    assert energies[inputs[0]] == pytest.approx(energies[inputs[2]])
+
+    monkeypatch.setattr(
+        "sys.argv", ["dftd3", "--jobs", "2", "--nprocs", "2", *inputs]
+    )
+    with pytest.raises(RuntimeError):
+        main()
+
+
+def test_fragment_labels():
+    bond_index = getinData(HERE / "examples/formic_acid_dimer.com").BONDINDEX
+
+    assert fragment_labels(bond_index) == [0] * 5 + [1] * 5
+    assert getMollist(bond_index, 7) == [5, 6, 7, 8, 9]
+
+    # a chain far longer than 100 bonds, a lone atom and a second chain
+    chain = [[1]] + [[i - 1, i + 1] for i in range(1, 499)] + [[498]]
+    bond_index = chain + [[]] + [[502], [501]]
+
+    assert fragment_labels(bond_index) == [0] * 500 + [1] + [2, 2]
+
+
+def test_infer_bonds():
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    coordinates, charges, functional = _from_txt(
+        HERE / "examples/formic_acid_dimer.txt"
+    )
+
+    assert infer_bonds(data.CHARGES, data.CARTESIANS) == data.BONDINDEX
+
+    # --inter without connectivity
+    inferred = D3Configuration(functional=functional, damp="bj", intermolecular=True)
+    given = D3Configuration(
+        functional=functional,
+        damp="bj",
+        intermolecular=True,
+        bond_index=data.BONDINDEX,
+    )
+
+    assert d3(inferred, charges, *coordinates) == pytest.approx(
+        d3(given, charges, *coordinates)
+    )
+
+
+def test_bonds_inferred_once(monkeypatch):
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    config = D3Configuration(functional=data.FUNCTIONAL, damp="bj", intermolecular=True)
+
+    calls = []
+
+    def counted(charges, coordinates):
+        calls.append(len(charges))
+        return infer_bonds(charges, coordinates)
+
+    monkeypatch.setattr("dftd3.dftd3.infer_bonds", counted)
+    gradient = D3_element_wise([(0, 0)], config, data.CHARGES, *data.CARTESIANS)
+    reference = D3_element_wise(
+        [(0, 0)],
+        D3Configuration(
+            functional=data.FUNCTIONAL,
+            damp="bj",
+            intermolecular=True,
+            bond_index=data.BONDINDEX,
+        ),
+        data.CHARGES,
+        *data.CARTESIANS,
+    )
+
+    assert calls == [10]
+    assert config.bond_index is None
+    assert gradient[0] == pytest.approx(reference[0], rel=1.0e-12)
+
+
+def test_intermolecular_threebody():
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    coordinates = list(data.CARTESIANS)
+    # pull the second formic acid away
+    for i in range(5, 10):
+        coordinates[3 * i] += 60.0
+
+    energies = [
+        d3(
+            D3Configuration(
+                functional=data.FUNCTIONAL,
+                damp="bj",
+                threebody=threebody,
+                intermolecular=True,
+                bond_index=data.BONDINDEX,
+            ),
+            data.CHARGES,
+            *coordinates,
+        )
+        for threebody in (False, True)
+    ]
+
+    # no triple within a single molecule is counted
+    assert energies[1] == pytest.approx(energies[0], abs=1.0e-14)
+
+
+def test_topological_distances():
+    # cyclobutane carbons with one substituent on atom 0
+    bond_index = [[1, 3, 4], [0, 2], [1, 3], [0, 2], [0]]
+
+    assert topological_distances(bond_index) == [
+        {1: 1, 3: 1, 4: 1, 2: 2},
+        {0: 1, 2: 1, 3: 2, 4: 2},
+        {1: 1, 3: 1, 0: 2, 4: 3},
+        {0: 1, 2: 1, 1: 2, 4: 2},
+        {0: 1, 1: 2, 3: 2, 2: 3},
+    ]
+
+
+def test_region():
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    coordinates = np.array(data.CARTESIANS)
+
+    def energy(region, xyz=coordinates, **options):
+        config = D3Configuration(
+            functional=data.FUNCTIONAL, damp="bj", region=region, **options
+        )
+        return d3(config, data.CHARGES, *xyz)
+
+    pairs = pair_energy_matrix(
+        D3Configuration(functional=data.FUNCTIONAL, damp="bj"),
+        data.CHARGES,
+        data.CARTESIANS,
+    )[:, 2]
+    i, j = np.triu_indices(10, k=1)
+
+    # pairs with an atom of the first formic acid
+    assert energy([0, 1, 2, 3, 4]) == pytest.approx(
+        pairs[(i < 5) | (j < 5)].sum(), rel=1.0e-12
+    )
+    # pairs of atom 3 with the atoms of its own molecule, all within 6 bohr
+    assert energy([3], region_cutoff=6.0) == pytest.approx(
+        pairs[((i == 3) & (j < 5)) | ((j == 3) & (i < 5))].sum(), rel=1.0e-12
+    )
+    assert energy(list(range(10)), threebody=True) == pytest.approx(
+        energy(None, threebody=True), rel=1.0e-12
+    )
+
+    # gradient with respect to the coordinates of atom 6 only
+    config = D3Configuration(functional=data.FUNCTIONAL, damp="bj", region=[6])
+    gradient = D3_derivatives(1, config, data.CHARGES, *coordinates)
+    step = 1.0e-4
+    for component in range(3):
+        shift = np.zeros(len(coordinates))
+        shift[18 + component] = step
+        difference = (
+            energy([6], coordinates + shift) - energy([6], coordinates - shift)
+        ) / (2 * step)
+        assert gradient[0, component] == pytest.approx(difference, rel=1.0e-6)
+
+    # a copy of the dimer far beyond the default cutoff, past the 447 atoms
+    # whose pairs fitted the former fixed-size pair arrays
+    far = (coordinates.reshape(-1, 3) + [1000.0, 0.0, 0.0]).ravel()
+    padding = np.tile(far, 45)
+    padding[::3] += np.repeat(1000.0 * np.arange(45), 10)
+    xyz = np.concatenate([padding, coordinates])
+    config = D3Configuration(
+        functional=data.FUNCTIONAL, damp="bj", threebody=True, region=[450, 451]
+    )
+    assert d3(config, data.CHARGES * 46, *xyz) == pytest.approx(
+        energy([0, 1], threebody=True), rel=1.0e-12
+    )
+
+
 def test_derv_sequence():
     assert _derv_sequence((3, 2, 1, 0)) == [0, 0, 0, 1, 1, 2]
     assert _derv_sequence((0, 1, 2, 3)) == [1, 2, 2, 3, 3, 3]
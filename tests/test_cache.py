@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from dftd3.cache import CachedData, ParseCache
+from dftd3.ccParse import getinData, getoutData
+
+HERE = Path(__file__).parents[1]
+
+
+def test_parse_cache(tmp_path):
+    cache = ParseCache(tmp_path / "cache")
+    log = tmp_path / "CH3F2TS.log"
+    shutil.copy(HERE / "examples/CH3F2TS.log", log)
+
+    parsed = cache.parse(log, getoutData)
+    cached = cache.parse(log, getoutData)
+
+    assert isinstance(cached, CachedData)
+    assert cached.CHARGES == parsed.CHARGES
+    assert cached.CARTESIANS == parsed.CARTESIANS
+    assert cached.FUNCTIONAL == parsed.FUNCTIONAL
+    assert cached.NORMALMODES == parsed.NORMALMODES
+
+    # a changed file is parsed again
+    with open(log, "a") as outfile:
+        outfile.write("\n")
+    assert not isinstance(cache.parse(log, getoutData), CachedData)
+    assert len(list(cache.path.glob("*.npz"))) == 2
+
+
+def test_parse_cache_bonds(tmp_path):
+    cache = ParseCache(tmp_path)
+    parsed = cache.parse(HERE / "examples/formic_acid_dimer.com", getinData)
+    cached = cache.parse(HERE / "examples/formic_acid_dimer.com", getinData)
+
+    assert cached.BONDINDEX == parsed.BONDINDEX
+    assert cached.CARTESIANS == parsed.CARTESIANS
+
+
+class _Parsed:
+    # a parser result with array and empty fields, and no NORMALMODES
+    def __init__(self, file):
+        self.CHARGES = np.array([6, 1])
+        self.CARTESIANS = np.zeros(6)
+        self.FREQUENCIES = []
+        self.FUNCTIONAL = None
+
+
+def test_parse_cache_fields(tmp_path):
+    cache = ParseCache(tmp_path / "cache")
+    parsed = cache.parse(HERE / "examples/CH3F.com", _Parsed)
+    cached = cache.parse(HERE / "examples/CH3F.com", _Parsed)
+
+    assert isinstance(cached, CachedData)
+    assert cached.NATOMS == 2
+    assert cached.CHARGES == parsed.CHARGES.tolist()
+    assert cached.FREQUENCIES == []
+    assert cached.NORMALMODES == []
+    assert cached.FUNCTIONAL is None
+
+
+def test_parse_cache_index(tmp_path):
+    # two caches on the same directory, as in concurrent runs, keep each
+    # other's index entries
+    first = ParseCache(tmp_path)
+    second = ParseCache(tmp_path)
+    com = HERE / "examples/CH3F.com"
+    log = HERE / "examples/CH3F2TS.log"
+
+    digest = first.digest(com)
+    second.digest(log)
+
+    assert len(list((tmp_path / "index").iterdir())) == 2
+    assert second.digest(com) == digest
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+
+import bz2
+import gzip
+import lzma
+from pathlib import Path
+
+import pytest
+
+from dftd3.ccParse import (
+    XYZTrajectory,
+    get_simple_data,
+    getcifData,
+    getinData,
+    getoutData,
+    getpdbData,
+    getxyzData,
+    input_extension,
+    input_stem,
+    iter_cif_frames,
+    iter_gaussian_frames,
+    iter_pdb_frames,
+    iter_xyz_frames,
+)
+from dftd3.constants import AU_TO_ANG
+
+HERE = Path(__file__).parents[1]
+
+
+def test_gaussian_frames():
+    frames = list(iter_gaussian_frames(HERE / "examples/CH3F2TS.log"))
+    last = getoutData(HERE / "examples/CH3F2TS.log")
+
+    assert [frame[0] for frame in frames] == [0, 1, 2, 3]
+    assert [frame[1] for frame in frames] == [None, 1, 2, 2]
+    assert frames[-1][2] == last.CHARGES
+    assert frames[-1][3] == pytest.approx(last.CARTESIANS)
+    # the first step moves the fluorines
+    assert frames[0][3][14] != pytest.approx(frames[1][3][14])
+
+
+def test_bond_index(tmp_path):
+    # only the route section turns on connectivity parsing
+    title = tmp_path / "title.com"
+    title.write_text(
+        "# b3lyp/6-31g(d)\n\nno connectivity here\n\n0 1\nH 0 0 0\nH 0 0 0.74\n\n"
+    )
+    assert getinData(title).BONDINDEX is None
+
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+
+    assert data.BONDINDEX == [
+        [1, 2, 3],
+        [0],
+        [0, 4],
+        [0],
+        [2],
+        [6, 7, 8],
+        [5],
+        [5, 9],
+        [5],
+        [7],
+    ]
+
+
+def test_xyz(tmp_path):
+    data = getxyzData(HERE / "examples/formic_acid_dimer.xyz")
+    reference = get_simple_data(HERE / "examples/formic_acid_dimer.txt")
+
+    assert data.NFRAMES == 1
+    assert data.CHARGES == reference.CHARGES
+    assert data.CARTESIANS == pytest.approx(reference.CARTESIANS)
+
+    trajectory = tmp_path / "trajectory.xyz"
+    trajectory.write_text(
+        "2\nProperties=id:I:1:species:S:1:pos:R:3\n1 O 0 0 0\n2 H 0 0 0.96\n"
+        "3\nplain XYZ\nC 0 0 0\no 1.2 0 0\n8 -1.2 0 0"
+    )
+    frames = XYZTrajectory(trajectory)
+
+    assert len(frames) == 2
+    assert frames.comment(1) == "plain XYZ"
+    assert frames[0][0].tolist() == [8, 1]
+    assert frames[0][1][5] == pytest.approx(0.96 / AU_TO_ANG)
+    assert frames[-1][0].tolist() == [6, 8, 8]
+    assert [frame[0] for frame in iter_xyz_frames(trajectory)] == [0, 1]
+
+    # extra columns on some lines only: parsed line by line
+    mixed = tmp_path / "mixed.xyz"
+    mixed.write_text("2\nforces on the first atom\nC 0 0 0 0.5 0.7\nO 1.2 0 0\n")
+    charges, cartesians = XYZTrajectory(mixed)[0]
+    assert charges.tolist() == [6, 8]
+    assert cartesians[3] == pytest.approx(1.2 / AU_TO_ANG)
+
+    # irregular lines whose tokens add up to three lines like the first one
+    irregular = tmp_path / "irregular.xyz"
+    irregular.write_text("3\n\nC 0 0 0 0.5\nO 1.2 0 0\nH 0 2.0 0 0.1 0.2\n")
+    charges, cartesians = XYZTrajectory(irregular)[0]
+    assert charges.tolist() == [6, 8, 1]
+    assert cartesians[3:].tolist() == pytest.approx(
+        [1.2 / AU_TO_ANG, 0.0, 0.0, 0.0, 2.0 / AU_TO_ANG, 0.0]
+    )
+
+
+def test_pdb(tmp_path):
+    data = getpdbData(HERE / "examples/formic_acid_dimer.pdb")
+    reference = get_simple_data(HERE / "examples/formic_acid_dimer.txt")
+
+    assert data.CHARGES == reference.CHARGES
+    # PDB coordinates are rounded to 1.0e-3 angstrom
+    assert data.CARTESIANS == pytest.approx(reference.CARTESIANS, abs=1.0e-3 / AU_TO_ANG)
+
+    models = tmp_path / "models.pdb"
+    models.write_text(
+        "MODEL        1\n"
+        "ATOM      1  N   GLY A   1      -1.000   2.000   3.000  1.00  0.00           N\n"
+        "ATOM      2  CA  GLY A   1      10.000-20.000  30.000  1.00  0.00\n"
+        "ENDMDL\n"
+        "MODEL        2\n"
+        "ATOM      1  N   GLY A   1      -1.500   2.000   3.000  1.00  0.00           N\n"
+        "ATOM      2  CA  GLY A   1      10.000-20.000  30.000  1.00  0.00\n"
+        "ENDMDL\n"
+    )
+    frames = list(iter_pdb_frames(models))
+
+    assert len(frames) == 2
+    assert frames[0][2] == [7, 6]
+    assert frames[0][3][3:6] == pytest.approx(
+        [10.0 / AU_TO_ANG, -20.0 / AU_TO_ANG, 30.0 / AU_TO_ANG]
+    )
+    assert frames[1][3][0] == pytest.approx(-1.5 / AU_TO_ANG)
+
+    # blank element columns: element from columns 13-14 of the atom name
+    ions = tmp_path / "ions.pdb"
+    ions.write_text(
+        "HETATM    1 FE   HEM A   1       0.000   0.000   0.000  1.00  0.00\n"
+        "HETATM    2 CL   CL  A   2       2.000   0.000   0.000  1.00  0.00\n"
+        "ATOM      3  CA  GLY A   3       4.000   0.000   0.000  1.00  0.00\n"
+        "ATOM      4 1HA  GLY A   3       5.000   0.000   0.000  1.00  0.00\n"
+        "ATOM      5 HG11 VAL A   4       6.000   0.000   0.000  1.00  0.00\n"
+        "ATOM      6 HE21 GLN A   5       7.000   0.000   0.000  1.00  0.00\n"
+        "HETATM    7 HG   HG  A   6       8.000   0.000   0.000  1.00  0.00\n"
+    )
+    assert getpdbData(ions).CHARGES == [26, 17, 6, 1, 1, 1, 80]
+
+    empty = tmp_path / "empty.pdb"
+    empty.write_text("HEADER    NOTHING\nEND\n")
+    assert list(iter_pdb_frames(empty)) == []
+    with pytest.raises(SystemExit):
+        getpdbData(empty)
+
+
+def test_cif(tmp_path):
+    structure = tmp_path / "water.cif"
+    structure.write_text(
+        "data_water\n"
+        "loop_\n"
+        "_atom_site.group_PDB\n"
+        "_atom_site.id\n"
+        "_atom_site.type_symbol\n"
+        "_atom_site.label_atom_id\n"
+        "_atom_site.Cartn_x\n"
+        "_atom_site.Cartn_y\n"
+        "_atom_site.Cartn_z\n"
+        "_atom_site.pdbx_PDB_model_num\n"
+        "HETATM 1 O  O   0.000 0.000 0.000 1\n"
+        "HETATM 2 H  H1  0.000 0.000 0.960 1\n"
+        "HETATM 3 H  \"H2'\" 0.930 0.000 -0.240 1\n"
+        "HETATM 1 O  O   0.100 0.000 0.000 2\n"
+        "HETATM 2 H  H1  0.000 0.000 0.960 2\n"
+        "HETATM 3 H  \"H2'\" 0.930 0.000 -0.240 2\n"
+        "#\n"
+    )
+    data = getcifData(structure)
+
+    assert data.CHARGES == [8, 1, 1]
+    assert data.CARTESIANS[8] == pytest.approx(-0.24 / AU_TO_ANG)
+    assert [frame[3][0] for frame in iter_cif_frames(structure)] == pytest.approx(
+        [0.0, 0.1 / AU_TO_ANG]
+    )
+
+
+@pytest.mark.parametrize("module, suffix", [(gzip, ".gz"), (lzma, ".xz"), (bz2, ".bz2")])
+def test_compressed(tmp_path, module, suffix):
+    log = tmp_path / f"CH3F2TS.log{suffix}"
+    log.write_bytes(module.compress((HERE / "examples/CH3F2TS.log").read_bytes()))
+    reference = getoutData(HERE / "examples/CH3F2TS.log")
+
+    assert input_extension(log) == ".log"
+    assert input_stem(log) == "CH3F2TS"
+    assert getoutData(log).CARTESIANS == reference.CARTESIANS
+
+    trajectory = tmp_path / f"trajectory.xyz{suffix}"
+    trajectory.write_bytes(
+        module.compress(b"2\ncomment\nO 0 0 0\nH 0 0 0.96\n1\ncomment\nC 0 0 1.5\n")
+    )
+    frames = list(iter_xyz_frames(trajectory))
+
+    first = getxyzData(trajectory)
+    assert first.NFRAMES is None
+    assert first.CHARGES == [8, 1]
+    with pytest.raises(RuntimeError):
+        XYZTrajectory(trajectory)
+    assert [frame[2] for frame in frames] == [[8, 1], [6]]
+    assert frames[1][3] == pytest.approx([0.0, 0.0, 1.5 / AU_TO_ANG])
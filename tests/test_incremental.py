@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from dftd3.ccParse import getinData
+from dftd3.dftd3 import D3Configuration, d3
+from dftd3.incremental import IncrementalD3
+
+HERE = Path(__file__).parents[1]
+
+
+@pytest.mark.parametrize("cn_threshold", [0.0, 1.0e-6])
+@pytest.mark.parametrize("intermolecular", [False, True])
+def test_incremental(intermolecular, cn_threshold):
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    config = D3Configuration(
+        functional=data.FUNCTIONAL,
+        damp="bj",
+        intermolecular=intermolecular,
+        bond_index=data.BONDINDEX,
+    )
+    xyz = np.array(data.CARTESIANS).reshape(-1, 3)
+
+    system = IncrementalD3(config, data.CHARGES, data.CARTESIANS, cn_threshold)
+    energy = d3(config, data.CHARGES, *xyz.ravel())
+    assert system.energy == pytest.approx(energy, rel=1.0e-12)
+
+    # move the second formic acid, then one atom of each
+    for atoms, shift in [([5, 6, 7, 8, 9], 0.5), ([1, 6], -0.2)]:
+        moved = xyz.copy()
+        moved[atoms] += shift
+        delta = system.delta(atoms, moved[atoms])
+        assert system.xyz == pytest.approx(xyz)
+
+        assert system.move(atoms, moved[atoms]) == delta
+        xyz = moved
+        reference = d3(config, data.CHARGES, *xyz.ravel())
+        assert delta == pytest.approx(reference - energy, rel=1.0e-8)
+        assert system.energy == pytest.approx(reference, rel=1.0e-10)
+        energy = reference
+
+
+def test_incremental_cutoff():
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    config = D3Configuration(functional=data.FUNCTIONAL, damp="bj")
+    xyz = np.array(data.CARTESIANS).reshape(-1, 3)
+    energy = d3(config, data.CHARGES, *xyz.ravel())
+
+    # a copy of the dimer beyond the cutoffs: no pairs are stored between them
+    copies = np.vstack([xyz, xyz + [200.0, 0.0, 0.0]])
+    system = IncrementalD3(config, data.CHARGES * 2, copies.ravel(), 0.0)
+    assert system.energy == pytest.approx(2 * energy, rel=1.0e-12)
+    assert sum(len(neighbors) for neighbors in system._neighbors) == 2 * 2 * 45
+
+    moved = xyz.copy()
+    moved[[5, 6]] += 0.3
+    delta = system.move([15, 16], moved[[5, 6]] + [200.0, 0.0, 0.0])
+    reference = d3(config, data.CHARGES, *moved.ravel())
+    assert delta == pytest.approx(reference - energy, rel=1.0e-8)
+    assert system.energy == pytest.approx(energy + reference, rel=1.0e-10)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from dftd3.ccParse import getinData
+from dftd3.dftd3 import D3Configuration, d3
+from dftd3.constants import CN_CUTOFF
+from dftd3.pairs import (
+    coordination_numbers,
+    fragment_energies,
+    packed_pair_energies,
+    pair_energy_matrix,
+)
+from dftd3.utils import fragment_labels, ncoord
+
+HERE = Path(__file__).parents[1]
+
+
+@pytest.mark.parametrize("bonded_scaling", [False, True])
+@pytest.mark.parametrize("damping", ["zero", "bj"])
+def test_fragment_energies(damping, bonded_scaling):
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    labels = fragment_labels(data.BONDINDEX)
+    config = D3Configuration(
+        functional=data.FUNCTIONAL,
+        damp=damping,
+        bonded_scaling=bonded_scaling,
+    )
+    intermolecular = D3Configuration(
+        functional=data.FUNCTIONAL,
+        damp=damping,
+        intermolecular=True,
+        bond_index=data.BONDINDEX,
+        bonded_scaling=bonded_scaling,
+    )
+
+    matrix = fragment_energies(config, data.CHARGES, data.CARTESIANS, labels)
+
+    assert matrix.shape == (2, 2)
+    assert matrix == pytest.approx(matrix.T)
+    assert np.triu(matrix).sum() == pytest.approx(
+        d3(config, data.CHARGES, *data.CARTESIANS), rel=1.0e-12
+    )
+    assert matrix[0, 1] == pytest.approx(
+        d3(intermolecular, data.CHARGES, *data.CARTESIANS), rel=1.0e-12
+    )
+
+
+def test_bonded_scaling():
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    energies = pair_energy_matrix(
+        D3Configuration(functional=data.FUNCTIONAL, damp="bj"),
+        data.CHARGES,
+        data.CARTESIANS,
+    )[:, 2]
+    i, j = np.triu_indices(10, k=1)
+    pairs = dict(zip(zip(i.tolist(), j.tolist()), energies))
+
+    # atoms of HC(=O)OH: C 0, O 1, O 2, H 3 on C, H 4 on O 2
+    excluded = [(0, 1), (0, 2), (0, 3), (2, 4), (1, 2), (1, 3), (2, 3), (0, 4)]
+    scaled = [(1, 4), (3, 4)]
+    expected = sum(pairs.values())
+    for offset in (0, 5):
+        for a, b in excluded:
+            expected -= pairs[a + offset, b + offset]
+        for a, b in scaled:
+            expected -= (1.0 - 1.0 / 1.2) * pairs[a + offset, b + offset]
+
+    config = D3Configuration(
+        functional=data.FUNCTIONAL,
+        damp="bj",
+        bond_index=data.BONDINDEX,
+        bonded_scaling=True,
+    )
+    assert d3(config, data.CHARGES, *data.CARTESIANS) == pytest.approx(
+        expected, rel=1.0e-12
+    )
+
+
+def test_coordination_cutoff():
+    # two carbon atoms just within and just beyond CN_CUTOFF of a third one
+    charges = [5, 5, 5]
+    coordinates = [0.0, 0.0, 0.0, CN_CUTOFF - 0.5, 0.0, 0.0, 0.0, CN_CUTOFF + 0.5, 0.0]
+    cn = [float(x) for x in ncoord(charges, coordinates)]
+    region = ncoord(charges, coordinates, atoms=[0, 1, 2])
+
+    # all atoms count in standard D3, only those within CN_CUTOFF in a region
+    assert cn[2] > 0.0
+    assert float(region[0]) > 0.0
+    assert float(region[2]) == 0.0
+    beyond = float(ncoord(charges[:2], coordinates[:3] + coordinates[6:])[0])
+    assert float(region[0]) == pytest.approx(cn[0] - beyond, rel=1.0e-12)
+    assert coordination_numbers(
+        np.array(charges), np.array(coordinates).reshape(-1, 3)
+    ) == pytest.approx(cn, rel=1.0e-12)
+
+
+@pytest.mark.parametrize("intermolecular", [False, True])
+def test_pair_energy_matrix(intermolecular):
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    config = D3Configuration(
+        functional=data.FUNCTIONAL,
+        damp="bj",
+        intermolecular=intermolecular,
+    )
+
+    energies = pair_energy_matrix(config, data.CHARGES, data.CARTESIANS)
+
+    assert energies.shape == (45, 3)
+    assert energies[:, 2] == pytest.approx(energies[:, 0] + energies[:, 1])
+    assert energies[:, 2].sum() == pytest.approx(
+        d3(config, data.CHARGES, *data.CARTESIANS), rel=1.0e-12
+    )
+    # pair (0, 1) is the C=O bond of the first formic acid
+    assert (energies[0] == 0.0).all() == intermolecular
+
+    # the same pairs, from the energy evaluation of d3
+    pairs = {}
+    d3(config, data.CHARGES, *data.CARTESIANS, pairs=pairs)
+    assert packed_pair_energies(pairs, 10) == pytest.approx(energies, rel=1.0e-12)
+
+
+@pytest.mark.parametrize("intermolecular", [False, True])
+@pytest.mark.parametrize("threebody", [False, True])
+def test_energy_decomposition(threebody, intermolecular):
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    config = D3Configuration(
+        functional=data.FUNCTIONAL,
+        damp="zero",
+        threebody=threebody,
+        intermolecular=intermolecular,
+        bond_index=data.BONDINDEX,
+    )
+
+    decomposition = {}
+    energy = d3(config, data.CHARGES, *data.CARTESIANS, decomposition=decomposition)
+
+    assert len(decomposition["atoms"]) == 10
+    assert sum(decomposition["atoms"]) == pytest.approx(energy, rel=1.0e-12)
+    assert sorted(decomposition["element pairs"]) == [
+        (1, 1),
+        (1, 6),
+        (1, 8),
+        (6, 6),
+        (6, 8),
+        (8, 8),
+    ]
+    pairs = pair_energy_matrix(config, data.CHARGES, data.CARTESIANS)
+    assert sum(decomposition["element pairs"].values()) == pytest.approx(
+        pairs[:, 2].sum(), rel=1.0e-12
+    )
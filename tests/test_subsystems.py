@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pyDFTD3 -- Python implementation of Grimme's D3 dispersion correction.
+# Copyright (C) 2020 Rob Paton and contributors.
+#
+# This file is part of pyDFTD3.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# For information on the complete list of contributors to the
+# pyDFTD3, see: <http://github.com/bobbypaton/pyDFTD3/>
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from dftd3.ccParse import getinData
+from dftd3.dftd3 import D3Configuration, d3
+from dftd3.subsystems import SubsystemD3, fragment_masks
+from dftd3.utils import fragment_labels
+
+HERE = Path(__file__).parents[1]
+
+
+@pytest.mark.parametrize("damping", ["zero", "bj"])
+def test_subsystems(damping):
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    config = D3Configuration(functional=data.FUNCTIONAL, damp=damping)
+    charges = np.array(data.CHARGES)
+    xyz = np.array(data.CARTESIANS).reshape(-1, 3)
+
+    system = SubsystemD3(config, data.CHARGES, data.CARTESIANS)
+    combos, masks = fragment_masks(fragment_labels(data.BONDINDEX), 1)
+    masks = np.vstack([masks, np.ones(len(charges), dtype=bool)])
+
+    energies = system.energies(masks)
+
+    assert combos == [(0,), (1,)]
+    for mask, energy in zip(masks, energies):
+        reference = d3(config, charges[mask].tolist(), *xyz[mask].ravel())
+        assert energy == pytest.approx(reference, rel=1.0e-12)
+    assert system.energy(masks[0]) == energies[0]
+
+
+@pytest.mark.parametrize("bonded_scaling", [False, True])
+@pytest.mark.parametrize("intermolecular", [False, True])
+def test_subsystem_dimers(intermolecular, bonded_scaling):
+    data = getinData(HERE / "examples/formic_acid_dimer.com")
+    # a third formic acid stacked over the first one
+    xyz = np.array(data.CARTESIANS).reshape(-1, 3)
+    xyz = np.vstack([xyz, xyz[:5] + [0.0, 0.0, 7.0]])
+    charges = np.array(data.CHARGES + data.CHARGES[:5])
+    bond_index = data.BONDINDEX + [
+        [atom + 10 for atom in bonded] for bonded in data.BONDINDEX[:5]
+    ]
+
+    def configuration(bond_index):
+        return D3Configuration(
+            functional=data.FUNCTIONAL,
+            damp="bj",
+            bond_index=bond_index,
+            intermolecular=intermolecular,
+            bonded_scaling=bonded_scaling,
+        )
+
+    # small blocks, so that the queries are split in several chunks
+    system = SubsystemD3(
+        configuration(bond_index), charges.tolist(), xyz.ravel(), block_size=4
+    )
+    combos, masks = fragment_masks(fragment_labels(bond_index), 2)
+    energies = system.energies(masks)
+
+    assert combos == [(0, 1), (0, 2), (1, 2)]
+    for mask, energy in zip(masks, energies):
+        # bonds of the dimer, renumbered
+        atoms = np.flatnonzero(mask)
+        position = {atom: index for index, atom in enumerate(atoms.tolist())}
+        bonds = [[position[b] for b in bond_index[atom]] for atom in atoms]
+        reference = d3(
+            configuration(bonds), charges[mask].tolist(), *xyz[mask].ravel()
+        )
+        assert energy == pytest.approx(reference, rel=1.0e-12)